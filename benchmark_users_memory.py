@@ -0,0 +1,56 @@
+"""
+Measures how much memory the users data takes per stored user, lookup indexes included
+
+Usage: python benchmark_users_memory.py [--users-per-server N] [--servers-per-player N] [users count ...]
+"""
+import gc
+import random
+import argparse
+import tracemalloc
+from users import ServersData, UserData
+
+ranks = ['unranked', 'bronze', 'silver', 'gold', 'platinum', 'diamond', 'master', 'challenger']
+
+
+def build_data(total_users, users_per_server, servers_per_player):
+    data = ServersData([])
+    server = None
+    players = max(total_users // servers_per_player, 1)
+    for i in range(total_users):
+        if i % users_per_server == 0:
+            server = data.create_server(str(300000000000000000 + i))
+        # Every player ends up in servers_per_player different servers
+        player = i % players
+        user = server.create_user(str(100000000000000000 + player))
+        server.set_user_game_data(user, 20000000 + player, 'Summoner {0}'.format(player))
+        # Copy of the string, as it comes decoded from Riot or from the file
+        user.rank = UserData.intern(''.join(random.choice(ranks)))
+        user.confirmed = i % 10 == 0
+    # Like a loaded file, memberships of one player share their account
+    data.share_accounts()
+    return data
+
+
+def measure(total_users, users_per_server, servers_per_player):
+    gc.collect()
+    tracemalloc.start()
+    data = build_data(total_users, users_per_server, servers_per_player)
+    gc.collect()
+    used_memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    print('{0} users in {1} servers, {2} servers per player: {3:.1f} MB, {4:.0f} bytes per user'.format(
+        data.total_users, data.total_servers, servers_per_player, used_memory / 2 ** 20, used_memory / total_users))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Users data memory benchmark')
+    parser.add_argument('users', type=int, nargs='*', default=[100000, 1000000])
+    parser.add_argument('--users-per-server', type=int, default=1000)
+    parser.add_argument('--servers-per-player', type=int, default=1)
+    args = parser.parse_args()
+    for total_users in args.users:
+        measure(total_users, args.users_per_server, args.servers_per_player)
+
+
+if __name__ == '__main__':
+    main()
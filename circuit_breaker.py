@@ -0,0 +1,97 @@
+import time
+import logging
+
+
+class CircuitBreaker:
+    """
+    Tracks Riot API health per region from the outcomes of real requests.
+    'closed' - requests go through, 'open' - requests fail right away,
+    'half-open' - a single probe request is let through to check if the API is back.
+    """
+    logger = logging.getLogger(__name__)
+
+    closed = 'closed'
+    open = 'open'
+    half_open = 'half-open'
+
+    default_failure_threshold = 5
+    default_reset_timeout = 60
+
+    def __init__(self, failure_threshold=default_failure_threshold, reset_timeout=default_reset_timeout):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._circuits = {}
+
+    def circuit(self, region):
+        circuit = self._circuits.get(region)
+        if circuit is None:
+            circuit = self._circuits[region] = RegionCircuit(region)
+        return circuit
+
+    def state(self, region):
+        circuit = self.circuit(region)
+        if circuit.state == CircuitBreaker.open and self.retry_in(region) <= 0:
+            return CircuitBreaker.half_open
+        return circuit.state
+
+    def is_available(self, region):
+        return self.state(region) != CircuitBreaker.open
+
+    def retry_in(self, region):
+        """Seconds left until an open circuit lets a probe request through"""
+        circuit = self.circuit(region)
+        if circuit.state != CircuitBreaker.open:
+            return 0
+        return max(circuit.opened_at + self.reset_timeout - time.time(), 0)
+
+    def allow_request(self, region):
+        circuit = self.circuit(region)
+        now = time.time()
+        if circuit.state == CircuitBreaker.closed:
+            return True
+        if circuit.state == CircuitBreaker.open:
+            if now < circuit.opened_at + self.reset_timeout:
+                circuit.rejected += 1
+                return False
+            self.logger.info('RiotAPI circuit for \'%s\' is half-open, sending a probe request', region)
+            circuit.state = CircuitBreaker.half_open
+            circuit.probe_started_at = now
+            return True
+        # Half-open: only one probe at a time, unless the previous one got lost
+        if now - circuit.probe_started_at > self.reset_timeout:
+            circuit.probe_started_at = now
+            return True
+        circuit.rejected += 1
+        return False
+
+    def record_success(self, region):
+        circuit = self.circuit(region)
+        if circuit.state != CircuitBreaker.closed:
+            self.logger.warning('RiotAPI for \'%s\' is working again, closing the circuit', region)
+        circuit.state = CircuitBreaker.closed
+        circuit.failures = 0
+
+    def record_failure(self, region):
+        circuit = self.circuit(region)
+        circuit.failures += 1
+        if circuit.state == CircuitBreaker.half_open or \
+                (circuit.state == CircuitBreaker.closed and circuit.failures >= self.failure_threshold):
+            self.logger.warning('RiotAPI for \'%s\' is not working (%s failures in a row), opening the circuit for %ss',
+                                region, circuit.failures, self.reset_timeout)
+            circuit.state = CircuitBreaker.open
+            circuit.opened_at = time.time()
+
+    @property
+    def stats(self):
+        return ['{0}: {1}, {2} failures in a row, {3} rejected'
+                .format(region, self.state(region), c.failures, c.rejected) for region, c in sorted(self._circuits.items())]
+
+
+class RegionCircuit:
+    def __init__(self, region):
+        self.region = region
+        self.state = CircuitBreaker.closed
+        self.failures = 0
+        self.rejected = 0
+        self.opened_at = 0
+        self.probe_started_at = 0
@@ -2,6 +2,7 @@
 
 import traceback
 import sys
+import signal
 import logging
 import asyncio
 import discord
@@ -218,6 +219,11 @@ class DiscordBot:
             return
         return on_message
 
+    @asyncio.coroutine
+    def cleanup(self):
+        """Called before the loop is closed, override to release bot resources"""
+        return
+
     def setup_events(self):
         """
         Set up all events for the Bot
@@ -241,6 +247,7 @@ class DiscordBot:
         loop = None
         try:
             loop = asyncio.get_event_loop()
+            self.handle_termination(loop)
             loop.run_until_complete(self.client.start(self.token))
         except Exception as e:
             DiscordBot.logger.error('Caught an exception: {0}', e)
@@ -251,7 +258,19 @@ class DiscordBot:
         finally:
             DiscordBot.logger.info('Bot is quitting')
             loop.run_until_complete(self.client.logout())
+            loop.run_until_complete(self.cleanup())
             loop.stop()
             loop.close()
             quit()
         return
+
+    def handle_termination(self, loop):
+        """SIGTERM closes the client like !halt does, so run() gets to cleanup() before the process exits"""
+        def on_terminate():
+            DiscordBot.logger.warning('SIGTERM received')
+            loop.create_task(self.client.close())
+        try:
+            loop.add_signal_handler(signal.SIGTERM, on_terminate)
+        except NotImplementedError:
+            # No event loop signal handlers on Windows
+            pass
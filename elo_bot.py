@@ -1,7 +1,6 @@
 import asyncio
 import os
 import traceback
-import time
 import logging
 import discord
 import json
@@ -9,7 +8,10 @@ import types
 import re
 from discord_bot import DiscordBot
 from riot import RiotAPI
+from rate_limiter import RequestPriority
 from users import Users, UserData
+from retention import RetentionEngine
+from refresh_scheduler import RefreshScheduler, RefreshCheckpoint
 from answers import Answers
 from emojis import Emojis
 from roles_manager import RolesManager
@@ -25,16 +27,15 @@ class EloBot(DiscordBot):
     private_message_error = 'Эй, пиши в канал на сервере, чтобы я знал где тебе ник или эло выставлять.'
     region_set_error = 'Введи один регион из `{0}`, например `!region euw`'.format(RiotAPI.allowed_regions)
 
-    api_check_period = 60
-    api_check_data = {'name': 'Xorboo', 'region': 'euw'}
     # Ranks that will require account confirmation
     confirmation_ranks = ['diamond', 'master', 'challenger']
     rollback_rank = 'bronze'
 
     initial_sleep_pause = 3    # Before starting autoupdate
     success_sleep_pause = 4     # After successful update (for Discord limits)
-    small_sleep_pause = 1       # After check without update (for RiotAPI limits)
-    long_sleep_pause = 300      # If over-limited RiotAPI
+    scheduler_max_wait = 10     # Autoupdate checks if it should still run at least that often
+    members_pass_pause = 10     # Between passes over the changed members
+    # RiotAPI limits are handled by RiotAPI.rate_limiter, requests wait for a permit there
 
     restricted_urls = [
         'riotworlds.com',
@@ -49,9 +50,25 @@ class EloBot(DiscordBot):
         self.logger.info('Loaded parameters file from \'%s\'', self.parameters_file_path)
 
         super(EloBot, self).__init__(self.parameters_data['discord'])
-        self.riot_api = RiotAPI(self.parameters_data['riot_api_key'])
+        self.riot_api = RiotAPI(self.parameters_data['riot_api_key'],
+                                self.parameters_data['riot'] if 'riot' in self.parameters_data else {},
+                                loop=self.client.loop)
         Users.salt = self.parameters_data['salt']
-        self.users = Users(data_folder)
+        self.users = Users(data_folder,
+                           self.parameters_data['storage'] if 'storage' in self.parameters_data else {})
+        self.retention = RetentionEngine(
+            self.users, self.parameters_data['retention'] if 'retention' in self.parameters_data else {})
+        self.refresh_parameters = self.parameters_data['refresh'] if 'refresh' in self.parameters_data else {}
+        # Riot limits are per region, so every region has its own queue and workers
+        self.refresh_schedulers = {}
+        self.refresh_workers = {}
+        self.workers_per_region = self.refresh_parameters.get('workers_per_region', 2)
+        self.refresh_checkpoint = RefreshCheckpoint(data_folder, self.refresh_parameters)
+        self.refresh_checkpoint.load(self.refresh_scheduler)
+        # (server id, member id) changed since the last members pass
+        self.dirty_members = set()
+        # Region -> opening time of the circuit the owner was told about
+        self.api_down_reported = {}
         self.emoji = Emojis()
 
         self.autoupdate_is_running = False
@@ -60,9 +77,6 @@ class EloBot(DiscordBot):
         self.autoupdate_verbose = \
             self.parameters_data['autoupdate_verbose'] if 'autoupdate_verbose' in self.parameters_data else True
 
-        self.last_api_check_time = 0
-        self.api_is_working = True
-
     def get_basic_hint(self, server_id):
         region = self.users.get_or_create_server(server_id).parameters.get_region().upper()
         return self._elo_command_hint.format(region)
@@ -76,14 +90,34 @@ class EloBot(DiscordBot):
     def all_tokens_are_valid(self):
         return self.token_is_valid and self.riot_api.key_is_valid
 
+    @asyncio.coroutine
+    def cleanup(self):
+        yield from super().cleanup()
+        yield from self.users.flush()
+        self.users.close()
+        yield from self.refresh_checkpoint.flush(self.refresh_schedulers)
+        yield from self.riot_api.close()
+
     def setup_events(self):
         super().setup_events()
 
         self.client.event(self.server_join())
         self.client.event(self.server_remove())
         self.client.event(self.event_join())
+        self.client.event(self.event_member_remove())
+        self.client.event(self.event_member_update())
+        self.client.event(self.event_role_update())
 
         self.launch_autoupdate_task()
+        if not self.users.storage.is_incremental:
+            self.client.loop.create_task(self.users.flusher())
+        if self.users.storage.is_compacting:
+            self.client.loop.create_task(self.users.compactor())
+        if self.users.storage.evicts_servers:
+            self.client.loop.create_task(self.users.evictor())
+        if self.retention.enabled:
+            self.client.loop.create_task(self.retention.run())
+        self.client.loop.create_task(self.refresh_checkpoint.run(self.refresh_schedulers))
 
     def launch_autoupdate_task(self):
         if self.autoupdate_elo and not self.autoupdate_is_running:
@@ -98,7 +132,10 @@ class EloBot(DiscordBot):
             self.display_invite_link()
             yield from self.set_status(self.STATUS)
 
+            self.update_departed_servers()
             for s in self.client.servers:
+                # Whatever happened while the bot was offline
+                self.mark_server_dirty(s)
                 self.logger.info('Updating data for server \'%s\'...', s)
                 prune_amount = yield from self.client.estimate_pruned_members(s, days=30)
                 self.logger.info('Inactive members for the last 30 days: %s/%s.', prune_amount, len(s.members))
@@ -107,6 +144,15 @@ class EloBot(DiscordBot):
             self.logger.info('Finished \'on_ready()\'')
         return on_ready
 
+    def update_departed_servers(self):
+        """The bot could be removed from servers or added back while it was offline"""
+        current_ids = set(s.id for s in self.client.servers)
+        for server_id in current_ids:
+            self.users.set_server_departed(server_id, False)
+        for server_id in self.users.data.known_server_ids():
+            if server_id not in current_ids:
+                self.users.set_server_departed(server_id, True)
+
     @property
     def should_run_autoupdate(self):
         return not self.client.is_closed and self.autoupdate_elo
@@ -119,97 +165,185 @@ class EloBot(DiscordBot):
         yield from self.client.wait_until_ready()
         yield from asyncio.sleep(self.initial_sleep_pause)
 
+        self.schedule_stored_users()
+        members_task = self.client.loop.create_task(self.autoupdate_members_loop())
         while self.should_run_autoupdate:
-            try:
-                yield from self.autoupdate_from_users()
-                yield from asyncio.sleep(self.success_sleep_pause)
-                yield from self.autoupdate_from_members()
-                yield from asyncio.sleep(self.success_sleep_pause)
-            except Exception:
-                self.logger.error('Autoupdate loop exception: {0}'.format(traceback.format_exc()))
-                yield from asyncio.sleep(self.success_sleep_pause)
+            self.start_region_workers()
+            yield from asyncio.sleep(self.scheduler_max_wait)
+        members_task.cancel()
 
         self.autoupdate_is_running = False
         self.logger.info('Autoupdate STOP')
 
+    def refresh_scheduler(self, region):
+        scheduler = self.refresh_schedulers.get(region)
+        if scheduler is None:
+            scheduler = self.refresh_schedulers[region] = RefreshScheduler(self.refresh_parameters)
+        return scheduler
+
+    def start_region_workers(self):
+        """Every region with a queue gets its workers, finished ones are replaced"""
+        for region in list(self.refresh_schedulers):
+            workers = [w for w in self.refresh_workers.get(region, []) if not w.done()]
+            while len(workers) < self.workers_per_region:
+                workers.append(self.client.loop.create_task(self.autoupdate_region_worker(region)))
+            self.refresh_workers[region] = workers
+
+    @staticmethod
+    def refresh_key(user):
+        """Memberships of one game account on all the servers of a region share one refresh"""
+        if user.game_id:
+            return 'id', user.game_id
+        return 'nickname', RiotAPI.normalize_nickname(user.nickname)
+
+    def schedule_user(self, server_data, user):
+        self.refresh_scheduler(server_data.parameters.get_region()).add(
+            EloBot.refresh_key(user), user.is_confirmed, (server_data.server_id, user.discord_id))
+
+    def schedule_stored_users(self):
+        for server_data in list(self.users.data.servers):
+            for user in server_data.users:
+                if user.has_data:
+                    self.schedule_user(server_data, user)
+        for region, scheduler in sorted(self.refresh_schedulers.items()):
+            self.logger.info('Refresh scheduler for %s: %s', region, scheduler)
+
+    @asyncio.coroutine
+    def autoupdate_region_worker(self, region):
+        self.logger.info('Autoupdate worker for %s START', region)
+        while self.should_run_autoupdate:
+            try:
+                yield from self.autoupdate_from_scheduler(region)
+            except Exception:
+                self.logger.error('Autoupdate worker exception: {0}'.format(traceback.format_exc()))
+                yield from asyncio.sleep(self.success_sleep_pause)
+        self.logger.info('Autoupdate worker for %s STOP', region)
+
     @asyncio.coroutine
-    def autoupdate_from_users(self):
-        self.logger.info('Autoupdating using USERS data')
-        if len(self.client.servers) == 0:
+    def autoupdate_from_scheduler(self, region):
+        """
+        Refreshes the game account of the region that is due first: RiotAPI is asked once and the answer is applied
+        to every server the account is on
+        """
+        scheduler = self.refresh_scheduler(region)
+        key = yield from scheduler.next_due(self.scheduler_max_wait)
+        if key is None:
+            return
+        memberships = []
+        for member_key in list(scheduler.members.get(key, ())):
+            server_id, discord_id = member_key
+            server_data = self.users.data.get_server(server_id)
+            user_data = server_data.get_user(discord_id) if server_data else None
+            if not user_data or not user_data.has_data:
+                scheduler.remove_member(key, member_key)
+                continue
+            server_region = server_data.parameters.get_region()
+            if server_region != region:
+                # Server region was changed
+                scheduler.move(key, member_key, self.refresh_scheduler(server_region))
+            elif EloBot.refresh_key(user_data) != key:
+                # User has set another game account since
+                scheduler.remove_member(key, member_key)
+                self.schedule_user(server_data, user_data)
+            elif self.find_member_by_id(server_id, discord_id)[1]:
+                memberships.append((server_data, user_data))
+        if not memberships:
+            if key in scheduler.members:
+                # Not on any of the servers right now
+                scheduler.postpone(key)
             return
 
-        server_index = 0
-        while server_index < self.users.data.total_servers:
-            server_data = self.users.data.get_server_by_index(server_index)
-            user_index = 0
-            while user_index < server_data.total_users:
-                if not self.should_run_autoupdate:
-                    return
-
-                try:
-                    success = False
-                    user_data = server_data.get_user_by_index(user_index)
-                    if user_data.has_data:
-                        success = yield from self.autoupdate_user(server_data, user_data)
-                    else:
-                        server, member = self.find_member_by_id(server_data.server_id, user_data.discord_id)
-                        if server and member:
-                            success = yield from self.clear_user_data(member, server)
-                            # Sending message only if user data was in storage,
-                            # otherwise it's just a nickname with brackets, so we silently clear them
-                            if success:
-                                channel = EloBot.get_bots_channel(server)
-                                yield from self.message(channel, '{0}, у тебя было что-то не так с ником, пофиксил его. '
-                                                        'Напиши `!nick` для возвращения эло.'.format(member.mention))
-                                yield from asyncio.sleep(self.success_sleep_pause)
-
-                    if success:
-                        yield from asyncio.sleep(self.success_sleep_pause)
-                    yield from asyncio.sleep(self.small_sleep_pause)
-
-                except Exception:
-                    self.logger.error('Autoupdate user_data exception: {0}'.format(traceback.format_exc()))
-                user_index += 1
-            server_index += 1
-        self.logger.info('Autoupdating using USERS data - completed')
+        yield from self.wait_for_region(region)
+        user_data = memberships[0][1]
+        try:
+            user_info = yield from self.riot_api.get_user_info(
+                region, user_id=user_data.game_id, nickname=user_data.nickname, priority=RequestPriority.background,
+                fresh_only=True)
+        except (RiotAPI.UserIdNotFoundException, RiotAPI.RiotRequestException) as e:
+            # Every membership handles the error on its own server
+            user_info = e
+
+        old_ranks = [user.rank for _, user in memberships]
+        success = False
+        for server_data, user_data in memberships:
+            updated = yield from self.autoupdate_user(server_data, user_data, user_info=user_info)
+            success = success or updated
+
+        if isinstance(user_info, Exception):
+            if not scheduler.is_scheduled(key):
+                scheduler.postpone(key)
+        else:
+            changed = any(user.rank != rank for (_, user), rank in zip(memberships, old_ranks))
+            scheduler.done(key, changed, any(user.is_confirmed for _, user in memberships))
+            for server_data, user_data in memberships:
+                new_key = EloBot.refresh_key(user_data)
+                if user_data.has_data and new_key != key:
+                    # Nickname was resolved to the game id
+                    scheduler.move(key, (server_data.server_id, user_data.discord_id), new_key=new_key)
+
+        if success:
+            yield from asyncio.sleep(self.success_sleep_pause)
+        else:
+            # Let other tasks run, checks without RiotAPI requests don't await anything
+            yield from asyncio.sleep(0)
 
     @asyncio.coroutine
-    def autoupdate_from_members(self):
-        self.logger.info('Autoupdating using MEMBERS data')
-        if len(self.client.servers) == 0:
-            return
+    def autoupdate_members_loop(self):
+        while self.should_run_autoupdate:
+            try:
+                yield from self.autoupdate_from_members()
+            except Exception:
+                self.logger.error('Autoupdate members exception: {0}'.format(traceback.format_exc()))
+            yield from asyncio.sleep(self.members_pass_pause)
 
-        server_index = 0
-        while server_index < len(self.client.servers):
-            server = list(self.client.servers)[server_index]
-            server_data = self.users.get_or_create_server(server.id)
-            channel = next((x for x in server.channels if x.name == 'bots' or x.name == 'bot'), server.default_channel)
-            member_index = 0
-            while member_index < len(server.members):
-                if not self.should_run_autoupdate:
-                    return
+    def mark_member_dirty(self, member):
+        self.dirty_members.add((member.server.id, member.id))
 
-                member = list(server.members)[member_index]
-                user_data = server_data.get_user(member.id)
+    def mark_server_dirty(self, server):
+        self.dirty_members.update((server.id, member.id) for member in server.members)
 
+    @asyncio.coroutine
+    def autoupdate_from_members(self):
+        """
+        Reconciles the members changed since the last pass: schedules the ones with data and clears nicknames of the
+        rest. Stored users are refreshed by the scheduler
+        """
+        if not self.dirty_members:
+            return
+        dirty_members, self.dirty_members = self.dirty_members, set()
+        self.logger.info('Autoupdating %s changed members', len(dirty_members))
+        try:
+            while dirty_members and self.should_run_autoupdate:
+                server_id, member_id = dirty_members.pop()
+                server, member = self.find_member_by_id(server_id, member_id)
+                if not member:
+                    continue
+                server_data = self.users.get_or_create_server(server_id)
+                user_data = server_data.get_user(member_id)
+
+                success = False
                 if user_data and user_data.has_data:
-                    success = yield from self.autoupdate_user(server_data, user_data)
+                    # Users of lazily loaded servers get scheduled when their server is loaded here
+                    self.schedule_user(server_data, user_data)
                 else:
                     success = yield from self.clear_user_data(member, server)
                     # Sending message only if user data was in storage,
                     # otherwise it's just a nickname with brackets, so we silently clear them
                     if user_data and success:
-                        yield from self.message(channel, '{0}, у тебя было что-то не так с ником, пофиксил его. '
+                        yield from self.message(EloBot.get_bots_channel(server),
+                                                '{0}, у тебя было что-то не так с ником, пофиксил его. '
                                                 'Напиши `!nick` для возвращения эло.'.format(member.mention))
                 if success:
                     yield from asyncio.sleep(self.success_sleep_pause)
-                yield from asyncio.sleep(self.small_sleep_pause)
-                member_index += 1
-            server_index += 1
-        self.logger.info('Autoupdating using MEMBERS data - completed')
+                else:
+                    yield from asyncio.sleep(0)
+        finally:
+            # Left for the next pass
+            self.dirty_members.update(dirty_members)
 
     @asyncio.coroutine
-    def autoupdate_user(self, server_data, user, force_silent=False):
+    def autoupdate_user(self, server_data, user, force_silent=False, priority=RequestPriority.background,
+                        user_info=None):
         server = self.client.get_server(server_data.server_id)
         if not server:
             return False
@@ -217,19 +351,30 @@ class EloBot(DiscordBot):
         if not server or not member:
             return False
 
+        if user_info is None:
+            yield from self.wait_for_region(server_data.parameters.get_region())
+
         is_silent = force_silent or not self.autoupdate_verbose
         channel = EloBot.get_bots_channel(server)
         result = yield from self.update_user(
-            member, user, channel, check_is_conflicted=True, silent=is_silent, is_new_data=False)
+            member, user, channel, check_is_conflicted=True, silent=is_silent, is_new_data=False, priority=priority,
+            user_info=user_info, fresh_only=True)
         if result.api_error:
             self.logger.error('Autoupdate request riot API error: %s', result.api_error)
-            yield from asyncio.sleep(self.long_sleep_pause)
 
         # Periodic extra save call in case we have changes
         self.users.save_users(check_if_dirty=True)
 
         return result.rank or result.name
 
+    @asyncio.coroutine
+    def wait_for_region(self, region):
+        """Waiting for RiotAPI to come back instead of failing every user in a row"""
+        if not self.riot_api.is_region_available(region):
+            retry_in = self.riot_api.circuit_breaker.retry_in(region)
+            self.logger.warning('RiotAPI for \'%s\' is down, pausing autoupdate for %.0fs', region, retry_in)
+            yield from asyncio.sleep(retry_in)
+
     @staticmethod
     def get_bots_channel(server):
         return next((x for x in server.channels if x.name == 'bots' or x.name == 'bot'), server.default_channel)
@@ -275,6 +420,8 @@ class EloBot(DiscordBot):
         def on_server_join(server):
             self.logger.info('Bot joined to the server \'%s\'', server)
             self.emoji.update_server(server)
+            self.users.set_server_departed(server.id, False)
+            self.mark_server_dirty(server)
         return on_server_join
 
     def server_remove(self):
@@ -282,6 +429,7 @@ class EloBot(DiscordBot):
         def on_server_remove(server):
             self.logger.info('Bot left the server \'%s\'', server)
             self.emoji.remove_server(server)
+            self.users.set_server_departed(server.id, True)
         return on_server_remove
 
     def event_join(self):
@@ -289,12 +437,14 @@ class EloBot(DiscordBot):
         def on_member_join(member):
             self.logger.info('User \'%s\' joined to the server \'%s\'', member.name, member.server)
             server = member.server
+            self.mark_member_dirty(member)
 
             server_data = self.users.get_or_create_server(server.id)
             user_data = server_data.get_user(member.id)
             success = False
             if user_data:
-                success = yield from self.autoupdate_user(server_data, user_data, force_silent=True)
+                success = yield from self.autoupdate_user(
+                    server_data, user_data, force_silent=True, priority=RequestPriority.join)
             # Force user to have default gray role
 
             if success:
@@ -308,6 +458,29 @@ class EloBot(DiscordBot):
                 yield from self.welcome_default(member)
         return on_member_join
 
+    def event_member_remove(self):
+        @asyncio.coroutine
+        def on_member_remove(member):
+            self.dirty_members.discard((member.server.id, member.id))
+        return on_member_remove
+
+    def event_member_update(self):
+        @asyncio.coroutine
+        def on_member_update(before, after):
+            if before.nick != after.nick or before.roles != after.roles:
+                self.mark_member_dirty(after)
+        return on_member_update
+
+    def event_role_update(self):
+        @asyncio.coroutine
+        def on_server_role_update(before, after):
+            # Renamed or moved elo role changes what its members should have
+            if before.name != after.name or before.position != after.position:
+                for member in after.server.members:
+                    if after in member.roles:
+                        self.mark_member_dirty(member)
+        return on_server_role_update
+
     @asyncio.coroutine
     def welcome_default(self, member):
         server = member.server
@@ -345,6 +518,37 @@ class EloBot(DiscordBot):
         else:
             yield from self.client.delete_message(mobj)
 
+    @DiscordBot.owner_action('')
+    @asyncio.coroutine
+    def riot_stats(self, _, mobj):
+        """
+        Статистика запросов к RiotAPI
+        """
+        lines = ['# Connection pools:'] + [str(s) for s in self.riot_api.pool.stats]
+        lines += ['# Requests:', str(self.riot_api.requests), str(self.riot_api.retry_policy)]
+        lines += ['# API health:'] + self.riot_api.circuit_breaker.stats
+        lines += ['# Rate limits:'] + self.riot_api.rate_limiter.stats
+        lines += ['# Summoners cache:', str(self.riot_api.summoners_cache)]
+        lines += ['# Positions cache:', str(self.riot_api.positions_cache)]
+        lines += ['# Refresh schedulers:'] + ['{0}: {1}, {2} workers'.format(
+            region, scheduler, len([w for w in self.refresh_workers.get(region, []) if not w.done()]))
+            for region, scheduler in sorted(self.refresh_schedulers.items())]
+        lines += ['Changed members waiting: {0}'.format(len(self.dirty_members))]
+        yield from self.message(mobj.channel, self.pre_text('\n'.join(lines)))
+
+    @DiscordBot.owner_action('')
+    @asyncio.coroutine
+    def storage_stats(self, _, mobj):
+        """
+        Статистика хранилища юзеров
+        """
+        data = self.users.data
+        lines = ['# Storage: {0}'.format(type(self.users.storage).__name__),
+                 'Servers: {0} known, {1} loaded'.format(len(data.known_server_ids()), data.total_servers),
+                 'Users: {0}'.format(data.total_users)]
+        lines += ['# Retention:'] + self.retention.stats
+        yield from self.message(mobj.channel, self.pre_text('\n'.join(lines)))
+
     @DiscordBot.owner_action('')
     @asyncio.coroutine
     def autoupdate(self, _, mobj):
@@ -482,7 +686,12 @@ class EloBot(DiscordBot):
             return True, False
 
     @asyncio.coroutine
-    def update_user(self, member, user, channel, check_is_conflicted=False, silent=False, is_new_data=True):
+    def update_user(self, member, user, channel, check_is_conflicted=False, silent=False, is_new_data=True,
+                    priority=RequestPriority.interactive, user_info=None, fresh_only=False):
+        """
+        user_info is RiotAPI.get_user_info result (or its error) already requested for all servers of the account.
+        Stale cached ranks are fine for commands only, updates without a user waiting ask for fresh_only ones
+        """
         result = types.SimpleNamespace()
         result.rank = result.name = False
         result.api_error = None
@@ -494,8 +703,13 @@ class EloBot(DiscordBot):
             # Getting user elo using RiotAPI
             server = self.users.get_or_create_server(channel.server.id)
             region = server.parameters.get_region()
-            rank, game_user_id, nickname = self.riot_api.get_user_info(
-                region, user_id=user.game_id, nickname=user.nickname)
+            is_shared_refresh = user_info is not None
+            if user_info is None:
+                user_info = yield from self.riot_api.get_user_info(
+                    region, user_id=user.game_id, nickname=user.nickname, priority=priority, fresh_only=fresh_only)
+            elif isinstance(user_info, Exception):
+                raise user_info
+            rank, game_user_id, nickname = user_info
             rank = rank.lower()
 
             if check_is_conflicted:
@@ -518,10 +732,11 @@ class EloBot(DiscordBot):
                     self.logger.debug('User {0} requested {1} using nickname \'{2}\', putting him to {3}'
                                       .format(member, rank, nickname, EloBot.rollback_rank).encode('utf-8'))
                     required_hash = UserData.create_hash(game_user_id, member.id)
-                    is_hash_correct, current_code = self.riot_api.check_user_verification(game_user_id, required_hash, region)
+                    is_hash_correct, current_code = yield from self.riot_api.check_user_verification(
+                        game_user_id, required_hash, region, priority=priority)
                     if is_hash_correct:
                         self.logger.debug('User {0} already has correct hash, confirming it'.format(member))
-                        yield from self.confirm_user(user, server, member, channel, silent=silent)
+                        yield from self.confirm_user(user, server, member, channel, silent=silent, priority=priority)
                     else:
                         self.logger.debug('User {0} is not confirmed, setting default rank'.format(member))
                         rank = EloBot.rollback_rank.lower()
@@ -534,7 +749,13 @@ class EloBot(DiscordBot):
             rank_changed = rank != old_rank
 
             # Saving user to database
-            self.users.update_user(user, game_user_id, nickname, rank)
+            self.users.update_user(server, user, game_user_id, nickname, rank)
+            if not is_shared_refresh:
+                # Shared refreshes are rescheduled once for the account by EloBot.autoupdate_from_scheduler
+                refresh_key = EloBot.refresh_key(user)
+                scheduler = self.refresh_scheduler(region)
+                scheduler.add(refresh_key, member=(server.server_id, user.discord_id))
+                scheduler.done(refresh_key, rank_changed, user.is_confirmed)
 
             # Updating users role on server
             roles_manager = RolesManager(channel.server.roles)
@@ -588,8 +809,7 @@ class EloBot(DiscordBot):
                     yield from self.message(channel, nick_error_reply)
 
         except RiotAPI.UserIdNotFoundException as _:
-            api_working = self.check_api_if_needed()
-            if api_working:
+            if self.riot_api.is_region_available(region):
                 requested_nickname = user.nickname
                 yield from self.clear_user_data(member, channel.server)
                 if not silent:
@@ -600,22 +820,17 @@ class EloBot(DiscordBot):
                         error_reply = '{0}, не нашел твоего ника `{1}` при обновлении, очистил твои данные'\
                             .format(member.mention, requested_nickname)
                     yield from self.message(channel, error_reply)
-            else:
-                if not silent and is_new_data:
-                    api_url = 'https://developer.riotgames.com/api-status/'
-                    yield from self.message(channel,
-                                            '{0}, судя по всему рито сломали их API. '
-                                            'Проверь тут ({1}), если все в порядке - напиши о проблеме `{2}` ({3}). '
-                                            'Но вообще я и сам ему напишу...'
-                                            .format(member.mention, api_url, self.owner, self.owner.mention))
-                    yield from self.message(self.owner, 'Тут на `{0}` юзер `{1}` пытается установить себе ник `{2}`, '
-                                                        'а АПИ лежит...'.format(channel.server, member, user.nickname))
+            elif not silent and is_new_data:
+                yield from self.reply_api_is_down(member, channel, region, user.nickname)
 
         except RiotAPI.RiotRequestException as e:
             result.api_error = e.error_code
             if not silent and is_new_data:
-                error_reply = '{0}, произошла ошибка при запросе к RiotAPI, попробуй попозже.'.format(member.mention)
-                yield from self.message(channel, error_reply)
+                if self.riot_api.is_region_available(region):
+                    error_reply = '{0}, произошла ошибка при запросе к RiotAPI, попробуй попозже.'.format(member.mention)
+                    yield from self.message(channel, error_reply)
+                else:
+                    yield from self.reply_api_is_down(member, channel, region, user.nickname)
 
         except RolesManager.RoleNotFoundException as _:
             if not silent and is_new_data:
@@ -636,11 +851,7 @@ class EloBot(DiscordBot):
         yield from self.client.send_typing(channel)
 
         # Setting new nickname - clearing user data before update
-        user = self.users.get_or_create_user(member)
-        if user.nickname != nickname:
-            user.game_id = None
-            user.nickname = nickname
-            user.confirmed = False
+        user = self.users.set_user_nickname(member, nickname)
 
         yield from self.update_user(member, user, channel, check_is_conflicted=True, silent=False)
 
@@ -680,7 +891,7 @@ class EloBot(DiscordBot):
             # Getting user elo using RiotAPI
             server = self.users.get_or_create_server(channel.server.id)
             region = server.parameters.get_region()
-            rank, game_user_id, real_nickname = self.riot_api.get_user_info(region, nickname=nickname)
+            rank, game_user_id, real_nickname = yield from self.riot_api.get_user_info(region, nickname=nickname)
 
             emojis = self.emoji.s(channel.server)
             rank_text = emojis.get(rank)
@@ -690,24 +901,19 @@ class EloBot(DiscordBot):
             yield from self.message(channel, reply)
 
         except RiotAPI.UserIdNotFoundException as _:
-            api_working = self.check_api_if_needed()
-            if api_working:
+            if self.riot_api.is_region_available(region):
                 error_reply = '{0}, ты рак, нет такого ника `{1}` в лиге на `{2}`. ' \
                     .format(member.mention, nickname, region.upper())
                 yield from self.message(channel, error_reply)
             else:
-                api_url = 'https://developer.riotgames.com/api-status/'
-                yield from self.message(channel,
-                                        '{0}, судя по всему рито сломали их API. '
-                                        'Проверь тут ({1}), если все в порядке - напиши о проблеме `{2}` ({3}). '
-                                        'Но вообще я и сам ему напишу...'
-                                        .format(member.mention, api_url, self.owner, self.owner.mention))
-                yield from self.message(self.owner, 'Тут на `{0}` юзер `{1}` пытается установить себе ник `{2}`, '
-                                                    'а АПИ лежит...'.format(channel.server, member, nickname))
+                yield from self.reply_api_is_down(member, channel, region, nickname)
 
         except RiotAPI.RiotRequestException as e:
-            error_reply = '{0}, произошла ошибка при запросе к RiotAPI, попробуй попозже.'.format(member.mention)
-            yield from self.message(channel, error_reply)
+            if self.riot_api.is_region_available(region):
+                error_reply = '{0}, произошла ошибка при запросе к RiotAPI, попробуй попозже.'.format(member.mention)
+                yield from self.message(channel, error_reply)
+            else:
+                yield from self.reply_api_is_down(member, channel, region, nickname)
 
         except RolesManager.RoleNotFoundException as _:
             yield from self.message(channel,
@@ -794,9 +1000,7 @@ class EloBot(DiscordBot):
 
     @asyncio.coroutine
     def change_user_cancer(self, member, channel, cancer):
-        user_data = self.users.get_or_create_user(member)
-        was_cancer = user_data.is_cancer
-        user_data.cancer = cancer
+        user_data, was_cancer = self.users.set_user_cancer(member, cancer)
         if user_data.has_data:
             yield from self.update_user(
                 member, user_data, channel, check_is_conflicted=False, silent=True, is_new_data=False)
@@ -918,7 +1122,8 @@ class EloBot(DiscordBot):
                                     .format(mobj.author.mention))
             return
 
-        has_correct_code, current_code = self.riot_api.check_user_verification(user_data.game_id, bind_hash, region)
+        has_correct_code, current_code = yield from self.riot_api.check_user_verification(
+            user_data.game_id, bind_hash, region)
         if has_correct_code:
             yield from self.confirm_user(user_data, server, mobj.author, mobj.channel)
         else:
@@ -928,9 +1133,10 @@ class EloBot(DiscordBot):
             yield from self.message(mobj.channel, fail_reply)
 
     @asyncio.coroutine
-    def confirm_user(self, user_data, server, author, channel, silent=False):
+    def confirm_user(self, user_data, server, author, channel, silent=False, priority=RequestPriority.interactive):
         conflicted_users = self.users.confirm_user(user_data, server)
-        yield from self.update_user(author, user_data, channel, check_is_conflicted=False, silent=True)
+        yield from self.update_user(author, user_data, channel, check_is_conflicted=False, silent=True,
+                                    priority=priority)
 
         if not silent:
             success_reply = 'Окей {0}, подтвердил твой игровой ник `{1}`'\
@@ -1034,18 +1240,18 @@ class EloBot(DiscordBot):
         yield from self.message(mobj.channel, 'Слушаюсь, милорд.')
         yield from self.client.close()
 
-    def check_api_if_needed(self):
-        current_time = time.time()
-        if current_time - self.last_api_check_time < self.api_check_period:
-            return self.api_is_working
-
-        self.logger.info('Checking Riot API status...')
-        self.last_api_check_time = current_time
-        self.api_is_working = False
-        try:
-            self.riot_api.get_summoner_data(self.api_check_data['region'], nickname=self.api_check_data['name'])
-            self.api_is_working = True
-            self.logger.info('Riot API is working properly.')
-        except RiotAPI.RiotRequestException as e:
-            self.logger.warning('Checking RiotAPI failed - api is not working, error: {0}'.format(e.error_code))
-        return self.api_is_working
+    @asyncio.coroutine
+    def reply_api_is_down(self, member, channel, region, nickname):
+        api_url = 'https://developer.riotgames.com/api-status/'
+        yield from self.message(channel,
+                                '{0}, судя по всему рито сломали их API. '
+                                'Проверь тут ({1}), если все в порядке - напиши о проблеме `{2}` ({3}). '
+                                'Но вообще я и сам ему напишу...'
+                                .format(member.mention, api_url, self.owner, self.owner.mention))
+        # Once per outage is enough for the owner, not once per command
+        opened_at = self.riot_api.circuit_breaker.circuit(region).opened_at
+        if self.api_down_reported.get(region) == opened_at:
+            return
+        self.api_down_reported[region] = opened_at
+        yield from self.message(self.owner, 'Тут на `{0}` юзер `{1}` пытается установить себе ник `{2}`, '
+                                            'а АПИ лежит...'.format(channel.server, member, nickname))
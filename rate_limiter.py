@@ -0,0 +1,296 @@
+import time
+import heapq
+import logging
+import asyncio
+import itertools
+from collections import deque
+
+
+class RateLimitBucket:
+    """
+    One 'limit:window' pair of a Riot rate limit. Riot counts requests in fixed windows: the first request
+    starts a window and nothing is given back until the window is over, then the count starts from zero.
+    """
+
+    def __init__(self, limit, window, used=0):
+        self.limit = limit
+        self.window = window
+        self.used = used
+        # A window that is already counting requests started no earlier than now
+        self.window_start = time.time() if used else None
+
+    def reset_if_over(self, now):
+        if self.window_start is not None and now >= self.window_start + self.window:
+            self.window_start = None
+            self.used = 0
+
+    def wait_time(self, now, reserve=0.0):
+        """Time until a request is allowed, keeping 'reserve' part of the limit for more important requests"""
+        self.reset_if_over(now)
+        if self.used + 1 + reserve * self.limit <= self.limit or self.window_start is None:
+            return 0
+        return self.window_start + self.window - now
+
+    def consume(self, now):
+        self.reset_if_over(now)
+        if self.window_start is None:
+            self.window_start = now
+        self.used += 1
+
+    def sync(self, used, now):
+        """Riot tells us how many requests were already counted in its current window"""
+        self.reset_if_over(now)
+        if used <= 1 or self.window_start is None:
+            # Riot's window started with this request, or one we don't know about: it ends no later than
+            # a window started now, its requests in flight are counted in it as well
+            self.window_start = now
+        self.used = max(self.used, used)
+
+    def __str__(self):
+        return '{0}/{1}:{2}'.format(self.used, self.limit, self.window)
+
+
+class RateLimit:
+    """All buckets of a single Riot limit (application or method), e.g. '20:1,100:120'"""
+
+    def __init__(self, limits_text):
+        self.limits_text = ''
+        self.buckets = []
+        self.blocked_until = 0
+        self.set_limits(limits_text)
+
+    @staticmethod
+    def parse(text):
+        pairs = []
+        for part in (text or '').split(','):
+            part = part.strip()
+            if not part:
+                continue
+            value, window = part.split(':')
+            pairs.append((int(value), int(window)))
+        return pairs
+
+    def set_limits(self, limits_text, counts_text=None):
+        counts = dict((window, used) for used, window in RateLimit.parse(counts_text))
+        self.limits_text = limits_text
+        self.buckets = [RateLimitBucket(limit, window, counts.get(window, 0))
+                        for limit, window in RateLimit.parse(limits_text)]
+
+    def update(self, limits_text, counts_text, now):
+        if not limits_text:
+            return
+        if limits_text != self.limits_text:
+            self.set_limits(limits_text, counts_text)
+            return
+        buckets = dict((b.window, b) for b in self.buckets)
+        for used, window in RateLimit.parse(counts_text):
+            if window in buckets:
+                buckets[window].sync(used, now)
+
+    def wait_time(self, now, reserve=0.0):
+        wait = max(self.blocked_until - now, 0)
+        for bucket in self.buckets:
+            wait = max(wait, bucket.wait_time(now, reserve))
+        return wait
+
+    def consume(self, now):
+        for bucket in self.buckets:
+            bucket.consume(now)
+
+    def __str__(self):
+        text = ', '.join(str(b) for b in self.buckets) or 'unlimited'
+        blocked = self.blocked_until - time.time()
+        if blocked > 0:
+            text += ' (blocked for {0:.0f}s)'.format(blocked)
+        return text
+
+
+class RequestPriority:
+    """Request classes, lower value is served first"""
+    interactive = 0     # Commands typed by users
+    join = 1            # Member joined the server
+    background = 2      # Autoupdate and cache refreshes
+
+    names = {interactive: 'interactive', join: 'join', background: 'background'}
+
+    # Part of the application limit that requests of this class can't use, it's left for the classes above
+    default_reserves = {interactive: 0.0, join: 0.1, background: 0.3}
+
+
+class PermitTicket:
+    """Priority of a request that can be raised while it waits, when a more important caller shares the request"""
+
+    def __init__(self, priority):
+        self.priority = priority
+        # (region, method, waiter) while the request is queued for a permit
+        self.waiting = None
+
+
+class RiotRateLimiter:
+    """
+    Hands out request permits per region, learning the application and method limits
+    from the X-*-Rate-Limit headers of Riot responses
+    """
+    logger = logging.getLogger(__name__)
+
+    # Development key limits, used until the first response tells us the real ones
+    default_app_limits = '20:1,100:120'
+    default_retry_after = 1
+
+    def __init__(self, app_limits=default_app_limits, reserves=None, loop=None):
+        self.initial_app_limits = app_limits
+        self.reserves = dict(RequestPriority.default_reserves)
+        self.reserves.update(reserves or {})
+        self.loop = loop
+        self._app_limits = {}
+        self._method_limits = {}
+        self._queues = {}
+        self._timers = {}
+        self._order = itertools.count()
+        self._waits = dict((p, deque(maxlen=1000)) for p in RequestPriority.names)
+
+    def app_limit(self, region):
+        limit = self._app_limits.get(region)
+        if limit is None:
+            limit = self._app_limits[region] = RateLimit(self.initial_app_limits)
+        return limit
+
+    def method_limit(self, region, method):
+        key = (region, method)
+        limit = self._method_limits.get(key)
+        if limit is None:
+            limit = self._method_limits[key] = RateLimit('')
+        return limit
+
+    @asyncio.coroutine
+    def acquire(self, region, method, priority=RequestPriority.interactive, ticket=None):
+        """Waits until a request to the method is allowed in the region and reserves it"""
+        loop = self.loop or asyncio.get_event_loop()
+        waiter = loop.create_future() if hasattr(loop, 'create_future') else asyncio.Future(loop=loop)
+        start_time = time.time()
+        if ticket is not None:
+            priority = ticket.priority
+            ticket.waiting = (region, method, waiter)
+        heapq.heappush(self._queues.setdefault(region, []), (priority, next(self._order), method, waiter))
+        self._dispatch(region)
+        try:
+            yield from waiter
+        finally:
+            if ticket is not None:
+                ticket.waiting = None
+        # A shared request is counted as the most important of its callers
+        if ticket is not None:
+            priority = ticket.priority
+        self._waits[priority].append(time.time() - start_time)
+
+    def raise_priority(self, ticket, priority):
+        """
+        Queues the waiting request once more with the higher priority, the old entry is skipped
+        as soon as the waiter gets its permit
+        """
+        if priority >= ticket.priority:
+            return
+        ticket.priority = priority
+        if ticket.waiting is not None:
+            region, method, waiter = ticket.waiting
+            heapq.heappush(self._queues.setdefault(region, []), (priority, next(self._order), method, waiter))
+            self._dispatch(region)
+
+    def _dispatch(self, region):
+        """Grants permits to the queued requests of the region, most important first"""
+        queue = self._queues.get(region)
+        if not queue:
+            return
+        now = time.time()
+        app_limit = self.app_limit(region)
+        next_wait = None
+        postponed = []
+        while queue:
+            priority, _, method, waiter = queue[0]
+            if waiter.done():
+                heapq.heappop(queue)
+                continue
+            # Everything behind this request needs the application limit as well, so nothing else can go
+            app_wait = app_limit.wait_time(now, self.reserves.get(priority, 0.0))
+            if app_wait > 0:
+                next_wait = app_wait if next_wait is None else min(next_wait, app_wait)
+                break
+            method_limit = self.method_limit(region, method)
+            method_wait = method_limit.wait_time(now)
+            if method_wait > 0:
+                # Requests to other methods are not blocked by this one
+                postponed.append(heapq.heappop(queue))
+                next_wait = method_wait if next_wait is None else min(next_wait, method_wait)
+                continue
+            heapq.heappop(queue)
+            app_limit.consume(now)
+            method_limit.consume(now)
+            waiter.set_result(None)
+
+        for item in postponed:
+            heapq.heappush(queue, item)
+        if next_wait is not None:
+            self._schedule_dispatch(region, next_wait)
+
+    def _schedule_dispatch(self, region, delay):
+        loop = self.loop or asyncio.get_event_loop()
+        when = loop.time() + delay
+        timer = self._timers.get(region)
+        if timer is not None:
+            if timer[0] <= when:
+                return
+            timer[1].cancel()
+        self.logger.debug('Rate limit reached for %s, next permit in %.2fs', region, delay)
+        handle = loop.call_at(when, self._on_timer, region)
+        self._timers[region] = (when, handle)
+
+    def _on_timer(self, region):
+        self._timers.pop(region, None)
+        self._dispatch(region)
+
+    def update(self, region, method, status, headers):
+        now = time.time()
+        app_limit = self.app_limit(region)
+        method_limit = self.method_limit(region, method)
+        app_limit.update(headers.get('X-App-Rate-Limit'), headers.get('X-App-Rate-Limit-Count'), now)
+        method_limit.update(headers.get('X-Method-Rate-Limit'), headers.get('X-Method-Rate-Limit-Count'), now)
+
+        if status == 429:
+            retry_after = RiotRateLimiter.retry_after(headers)
+            limit_type = headers.get('X-Rate-Limit-Type', 'service')
+            self.logger.warning('Riot rate limit (%s) exceeded for %s/%s, retrying after %ss',
+                                limit_type, region, method, retry_after)
+            blocked_limit = app_limit if limit_type == 'application' else method_limit
+            blocked_limit.blocked_until = max(blocked_limit.blocked_until, now + retry_after)
+        # Learned limits can let queued requests go earlier
+        self._dispatch(region)
+
+    @staticmethod
+    def retry_after(headers):
+        try:
+            return float(headers.get('Retry-After', RiotRateLimiter.default_retry_after))
+        except ValueError:
+            return RiotRateLimiter.default_retry_after
+
+    @property
+    def stats(self):
+        lines = ['{0}: {1}'.format(region, limit) for region, limit in sorted(self._app_limits.items())]
+        lines += ['{0}/{1}: {2}'.format(region, method, limit)
+                  for (region, method), limit in sorted(self._method_limits.items()) if limit.buckets]
+        for region, queue in sorted(self._queues.items()):
+            # A promoted waiter is queued twice, its best priority is the one that counts
+            priorities = {}
+            for p, _, _, w in queue:
+                if not w.done():
+                    priorities[w] = min(p, priorities.get(w, p))
+            waiting = list(priorities.values())
+            if waiting:
+                lines.append('{0} queue: {1}'.format(region, ', '.join(
+                    '{0} {1}'.format(waiting.count(p), name) for p, name in sorted(RequestPriority.names.items()))))
+        for priority, name in sorted(RequestPriority.names.items()):
+            waits = sorted(self._waits[priority])
+            if waits:
+                p99 = waits[min(len(waits) - 1, int(len(waits) * 0.99))]
+                lines.append('{0} wait: avg {1:.0f}ms, p99 {2:.0f}ms'
+                             .format(name, 1000 * sum(waits) / len(waits), 1000 * p99))
+        return lines
@@ -0,0 +1,268 @@
+import os
+import json
+import time
+import heapq
+import logging
+import asyncio
+import itertools
+from users_storage import atomic_write
+
+
+class RefreshState:
+    """What the scheduler knows about one refreshed key"""
+    __slots__ = ('last_refresh', 'change_rate', 'confirmed')
+
+    def __init__(self, last_refresh=0, change_rate=0.5, confirmed=False):
+        self.last_refresh = last_refresh
+        # Moving average of 'rank changed' over the refreshes, 0..1
+        self.change_rate = change_rate
+        self.confirmed = confirmed
+
+
+class RefreshScheduler:
+    """
+    Priority queue of keys by the time they are due for a refresh. The interval is shorter for users whose rank
+    changes often and for confirmed (high elo) users, and always stays within [min_interval, max_interval].
+    Keys that were never refreshed are due right away. A key can have members that share its refresh.
+    """
+    logger = logging.getLogger(__name__)
+
+    default_min_interval = 15 * 60
+    default_max_interval = 24 * 3600
+    default_confirmed_factor = 0.5
+    # Weight of the last refresh in the change rate
+    change_rate_weight = 0.3
+
+    def __init__(self, parameters=None):
+        parameters = parameters or {}
+        self.min_interval = parameters.get('min_interval', RefreshScheduler.default_min_interval)
+        self.max_interval = parameters.get('max_interval', RefreshScheduler.default_max_interval)
+        self.confirmed_factor = parameters.get('confirmed_factor', RefreshScheduler.default_confirmed_factor)
+        self.states = {}
+        self.members = {}
+        # (due time, order, key), entries that don't match self._due are stale and skipped
+        self._heap = []
+        self._due = {}
+        self._order = itertools.count()
+        self._changed = asyncio.Event()
+        self.refreshes = 0
+        self.changes = 0
+
+    def interval(self, state):
+        interval = self.max_interval - (self.max_interval - self.min_interval) * state.change_rate
+        if state.confirmed:
+            interval *= self.confirmed_factor
+        return min(max(interval, self.min_interval), self.max_interval)
+
+    def is_scheduled(self, key):
+        return key in self._due
+
+    def add(self, key, confirmed=False, member=None):
+        """Schedules a key by its refresh history, does nothing if it's already scheduled"""
+        state = self.states.get(key)
+        if state is None:
+            state = self.states[key] = RefreshState()
+        state.confirmed = state.confirmed or confirmed
+        if member is not None:
+            self.members.setdefault(key, set()).add(member)
+        if key not in self._due:
+            self._push(key, state.last_refresh + self.interval(state) if state.last_refresh else time.time())
+
+    def remove(self, key):
+        self._due.pop(key, None)
+        self.states.pop(key, None)
+        self.members.pop(key, None)
+
+    def remove_member(self, key, member):
+        """The key goes away with its last member"""
+        members = self.members.get(key)
+        if members is not None:
+            members.discard(member)
+            if members:
+                return
+        self.remove(key)
+
+    def move(self, key, member, scheduler=None, new_key=None):
+        """Hands a member of the key to another scheduler or key, the history goes along if the key is new there"""
+        scheduler = self if scheduler is None else scheduler
+        new_key = key if new_key is None else new_key
+        state = self.states.get(key)
+        if new_key not in scheduler.states and state is not None:
+            scheduler.states[new_key] = RefreshState(state.last_refresh, state.change_rate, state.confirmed)
+        scheduler.add(new_key, state.confirmed if state else False, member)
+        self.remove_member(key, member)
+
+    def postpone(self, key, delay=None):
+        """Key couldn't be refreshed now, tries it again later without touching its history"""
+        self._push(key, time.time() + (self.min_interval if delay is None else delay))
+
+    def done(self, key, changed, confirmed=None):
+        """Key was refreshed, the next refresh is scheduled by how often it changes"""
+        state = self.states.get(key)
+        if state is None:
+            state = self.states[key] = RefreshState()
+        state.change_rate += RefreshScheduler.change_rate_weight * ((1.0 if changed else 0.0) - state.change_rate)
+        state.last_refresh = time.time()
+        if confirmed is not None:
+            state.confirmed = confirmed
+        self.refreshes += 1
+        if changed:
+            self.changes += 1
+        self._push(key, state.last_refresh + self.interval(state))
+
+    def history(self, since):
+        """(key, last_refresh, change_rate, confirmed) of the keys refreshed after since"""
+        return [(key, state.last_refresh, state.change_rate, state.confirmed)
+                for key, state in self.states.items() if state.last_refresh > since]
+
+    def restore(self, key, last_refresh, change_rate, confirmed):
+        """History saved before a restart, keys that are known already keep their own"""
+        if key not in self.states:
+            self.states[key] = RefreshState(last_refresh, change_rate, confirmed)
+
+    def _push(self, key, due):
+        self._due[key] = due
+        heapq.heappush(self._heap, (due, next(self._order), key))
+        if len(self._heap) > 2 * len(self._due) + 1000:
+            self._heap = [(d, o, k) for d, o, k in self._heap if self._due.get(k) == d]
+            heapq.heapify(self._heap)
+        self._changed.set()
+
+    def _top(self):
+        while self._heap:
+            due, _, key = self._heap[0]
+            if self._due.get(key) == due:
+                return self._heap[0]
+            heapq.heappop(self._heap)
+        return None
+
+    def pop_due(self, now=None):
+        """Takes the most overdue key, None if nothing is due yet"""
+        top = self._top()
+        if top is None or top[0] > (now or time.time()):
+            return None
+        heapq.heappop(self._heap)
+        del self._due[top[2]]
+        return top[2]
+
+    @asyncio.coroutine
+    def next_due(self, max_wait):
+        """Waits for a due key and takes it, None if nothing got due in max_wait seconds"""
+        deadline = time.time() + max_wait
+        while True:
+            now = time.time()
+            key = self.pop_due(now)
+            if key is not None:
+                return key
+            if now >= deadline:
+                return None
+            top = self._top()
+            wait_until = deadline if top is None else min(top[0], deadline)
+            self._changed.clear()
+            try:
+                yield from asyncio.wait_for(self._changed.wait(), wait_until - now)
+            except asyncio.TimeoutError:
+                pass
+
+    def __len__(self):
+        return len(self._due)
+
+    def __str__(self):
+        now = time.time()
+        overdue = sum(1 for due in self._due.values() if due <= now)
+        top = self._top()
+        next_due = 'nothing scheduled' if top is None else 'next in {0:.0f}s'.format(max(top[0] - now, 0))
+        members = sum(len(m) for m in self.members.values())
+        return '{0} scheduled for {1} members, {2} due, {3}; {4} refreshes, {5} changed'.format(
+            len(self._due), members, overdue, next_due, self.refreshes, self.changes)
+
+
+class RefreshCheckpoint:
+    """
+    Refresh history of the region schedulers saved to a file, so after a restart keys are due where they were
+    instead of everything being refreshed from the start again
+    """
+    logger = logging.getLogger(__name__)
+
+    file_name = 'refresh_state.json'
+    format_version = 1
+    default_period = 300
+
+    def __init__(self, data_folder, parameters=None):
+        parameters = parameters or {}
+        self.path = os.path.join(data_folder, RefreshCheckpoint.file_name)
+        self.period = parameters.get('checkpoint_period', RefreshCheckpoint.default_period)
+        self.save_future = None
+        self.saved_refreshes = None
+
+    def load(self, get_scheduler):
+        """Restores the history into the scheduler get_scheduler(region) returns"""
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                checkpoint = json.load(f)
+        except (OSError, ValueError) as e:
+            self.logger.error('Failed to load refresh checkpoint \'%s\': %s', self.path, e)
+            return
+        if checkpoint.get('version') != RefreshCheckpoint.format_version:
+            self.logger.warning('Refresh checkpoint version %s is not supported, starting over',
+                                checkpoint.get('version'))
+            return
+        restored = 0
+        for region, records in checkpoint['regions'].items():
+            scheduler = get_scheduler(region)
+            for key, last_refresh, change_rate, confirmed in records:
+                # Tuple keys come back from json as lists
+                scheduler.restore(tuple(key) if isinstance(key, list) else key, last_refresh, change_rate, confirmed)
+                restored += 1
+        self.logger.info('Restored refresh history of %s keys saved %.0fs ago',
+                         restored, time.time() - checkpoint['saved_at'])
+
+    @staticmethod
+    def snapshot(schedulers):
+        """History older than max_interval is not worth keeping, those keys are due anyway"""
+        now = time.time()
+        return {'version': RefreshCheckpoint.format_version,
+                'saved_at': now,
+                'regions': dict((region, scheduler.history(now - scheduler.max_interval))
+                                for region, scheduler in schedulers.items())}
+
+    def write(self, snapshot):
+        atomic_write(self.path, json.dumps(snapshot))
+
+    @staticmethod
+    def total_refreshes(schedulers):
+        return sum(scheduler.refreshes for scheduler in schedulers.values())
+
+    def start_save(self, schedulers):
+        """Snapshot is taken on the loop, encoding and writing happen in a worker thread"""
+        self.saved_refreshes = RefreshCheckpoint.total_refreshes(schedulers)
+        loop = asyncio.get_event_loop()
+        self.save_future = loop.run_in_executor(None, self.write, RefreshCheckpoint.snapshot(schedulers))
+        self.save_future.add_done_callback(self.on_save_done)
+
+    def on_save_done(self, future):
+        self.save_future = None
+        if future.cancelled() or future.exception() is not None:
+            self.saved_refreshes = None
+            self.logger.error('Failed to save refresh checkpoint: %s',
+                              None if future.cancelled() else future.exception())
+
+    @asyncio.coroutine
+    def run(self, schedulers):
+        self.logger.info('Refresh checkpoint START, period %ss', self.period)
+        while True:
+            yield from asyncio.sleep(self.period)
+            if self.save_future is None and self.saved_refreshes != RefreshCheckpoint.total_refreshes(schedulers):
+                self.start_save(schedulers)
+
+    @asyncio.coroutine
+    def flush(self, schedulers):
+        """Waits for the running save and writes the latest history, used on shutdown"""
+        if self.save_future is not None:
+            yield from asyncio.wait([self.save_future])
+        try:
+            self.write(RefreshCheckpoint.snapshot(schedulers))
+        except OSError as e:
+            self.logger.error('Failed to save refresh checkpoint: %s', e)
@@ -0,0 +1,106 @@
+import time
+import logging
+import traceback
+import asyncio
+
+
+class RetentionEngine:
+    """
+    Background pruning of the users data: servers the bot left long ago and user records with nothing in them.
+    Works in small batches, so the event loop is never blocked for long.
+    """
+    logger = logging.getLogger(__name__)
+
+    default_period = 6 * 3600
+    default_departed_server_days = 30
+    default_batch_size = 500
+
+    def __init__(self, users, parameters=None):
+        parameters = parameters or {}
+        self.users = users
+        self.period = parameters.get('period', RetentionEngine.default_period)
+        # None or 0 keeps departed servers forever
+        self.departed_server_days = parameters.get('departed_server_days',
+                                                   RetentionEngine.default_departed_server_days)
+        self.prune_empty_users = parameters.get('prune_empty_users', True)
+        self.batch_size = parameters.get('batch_size', RetentionEngine.default_batch_size)
+        self.passes = 0
+        self.reclaimed_servers = 0
+        self.reclaimed_users = 0
+        self.last_pass_time = None
+
+    @property
+    def enabled(self):
+        return bool(self.departed_server_days) or self.prune_empty_users
+
+    @asyncio.coroutine
+    def run(self):
+        self.logger.info('Retention START, period %ss', self.period)
+        while self.enabled:
+            yield from asyncio.sleep(self.period)
+            try:
+                yield from self.prune()
+            except Exception:
+                self.logger.error('Retention pass exception: {0}'.format(traceback.format_exc()))
+
+    @asyncio.coroutine
+    def prune(self):
+        start_time = time.time()
+        servers = yield from self.prune_departed_servers()
+        users = yield from self.prune_empty_user_records()
+        self.passes += 1
+        self.reclaimed_servers += servers
+        self.reclaimed_users += users
+        self.last_pass_time = time.time()
+        self.logger.info('Retention pass reclaimed %s servers and %s users in %.1fs, %s servers and %s users are left',
+                         servers, users, self.last_pass_time - start_time,
+                         len(self.users.data.known_server_ids()), self.users.data.total_users)
+
+    @asyncio.coroutine
+    def prune_departed_servers(self):
+        if not self.departed_server_days:
+            return 0
+        server_ids = self.users.data.departed_before(time.time() - self.departed_server_days * 24 * 3600)
+        for i, server_id in enumerate(server_ids):
+            self.users.remove_server(server_id)
+            if (i + 1) % self.batch_size == 0:
+                yield from asyncio.sleep(0)
+        return len(server_ids)
+
+    @staticmethod
+    def is_empty_user(user):
+        return not user.has_data and not user.is_cancer and not user.is_confirmed
+
+    @asyncio.coroutine
+    def prune_empty_user_records(self):
+        """Only loaded servers are checked, sharded storage doesn't load the cold ones for this"""
+        if not self.prune_empty_users:
+            return 0
+        pruned = 0
+        checked = 0
+        for server in list(self.users.data.servers):
+            empty_ids = []
+            for user in list(server.users):
+                if RetentionEngine.is_empty_user(user):
+                    empty_ids.append(user.discord_id)
+                checked += 1
+                if checked % self.batch_size == 0:
+                    yield from asyncio.sleep(0)
+            if empty_ids and self.users.data.get_server(server.server_id) is server:
+                # Users could fill their data in while we were waiting
+                empty_ids = [i for i in empty_ids if server.has_user(i) and
+                             RetentionEngine.is_empty_user(server.get_user(i))]
+                if empty_ids:
+                    self.users.remove_users_data(server, empty_ids)
+                    pruned += len(empty_ids)
+        return pruned
+
+    @property
+    def stats(self):
+        departed = self.users.data.departed
+        oldest_days = (time.time() - min(departed.values())) / 24 / 3600 if departed else 0
+        return ['Policies: departed servers kept {0} days, prune empty users {1}'
+                .format(self.departed_server_days or 'forever', self.prune_empty_users),
+                'Passes: {0}, reclaimed {1} servers and {2} users'
+                .format(self.passes, self.reclaimed_servers, self.reclaimed_users),
+                'Departed servers: {0}, oldest left {1:.1f} days ago'.format(len(departed), oldest_days)]
@@ -0,0 +1,47 @@
+import random
+
+
+class RetryPolicy:
+    """Decides if and when a failed Riot request is repeated: jittered exponential backoff within a deadline"""
+
+    default_attempts = 3
+    default_base_delay = 0.5
+    default_max_delay = 10
+    default_deadline = 20
+
+    # None stands for network errors and timeouts
+    retry_codes = (None, 429, 500, 502, 503, 504)
+
+    def __init__(self, attempts=default_attempts, base_delay=default_base_delay, max_delay=default_max_delay,
+                 deadline=default_deadline):
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.retries = 0
+        self.gave_up = 0
+
+    def next_delay(self, error_code, attempt, remaining, retry_after=None):
+        """
+        Returns seconds to wait before the next attempt, or None if the request shouldn't be repeated.
+        'remaining' is the time left until the deadline of the whole call
+        """
+        if error_code not in self.retry_codes:
+            return None
+        if attempt + 1 >= self.attempts:
+            self.gave_up += 1
+            return None
+
+        # 'Full jitter', so requests failed together don't come back together
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        if retry_after:
+            delay = max(delay, retry_after)
+        # No time left for an attempt after the backoff
+        if delay >= remaining:
+            self.gave_up += 1
+            return None
+        self.retries += 1
+        return delay
+
+    def __str__(self):
+        return '{0} attempts, {1} retries, {2} gave up'.format(self.attempts, self.retries, self.gave_up)
@@ -1,9 +1,16 @@
 import os
 import json
+import time
 import logging
-import urllib.request
-import urllib.error
-from urllib.parse import quote
+import asyncio
+import urllib.parse
+import aiohttp
+from riot_http import RiotConnectionPool
+from rate_limiter import RiotRateLimiter, RequestPriority, PermitTicket
+from ttl_cache import TTLCache, StaleWhileRevalidateCache
+from single_flight import SingleFlight
+from retry_policy import RetryPolicy
+from circuit_breaker import CircuitBreaker
 
 
 class RiotAPI:
@@ -29,6 +36,19 @@ class RiotAPI:
     _league_url = 'lol/league/v3/'
     _confirm_url = 'lol/platform/v3/third-party-code/by-summoner'
 
+    # Method names for the rate limiter, Riot counts method limits per endpoint
+    summoner_by_id_method = 'summoner-by-id'
+    summoner_by_name_method = 'summoner-by-name'
+    positions_method = 'league-positions'
+    confirm_method = 'third-party-code'
+
+    # Error code for requests rejected without calling Riot, because the region API is down
+    circuit_open_code = 'circuit-open'
+    # Error code for requests that ran out of their retry deadline before getting an answer
+    deadline_code = 'deadline'
+    # Error code for a by-id 404 that couldn't be told apart from a broken API, see confirm_missing
+    unconfirmed_missing_code = 'unconfirmed-404'
+
     allowed_regions = 'euw | eune | na | ru | kr | br | oce | jp | tr | lan | las'
     _regions = {
         'euw': {'base': 'euw1', 'league': 'euw'},
@@ -44,9 +64,52 @@ class RiotAPI:
         'las': {'base': 'la2', 'league': 'las'}
     }
 
-    def __init__(self, riot_key):
+    request_timeout = 10
+    default_summoners_cache_size = 10000
+    default_summoners_cache_ttl = 3600
+    default_positions_cache_size = 10000
+    default_positions_fresh_ttl = 300
+    default_positions_stale_ttl = 24 * 3600
+
+    def __init__(self, riot_key, parameters=None, loop=None):
         self._api_key = ""
         self.api_key = riot_key
+        self.loop = loop
+
+        parameters = parameters or {}
+        # Can point to a local stand-in server, see riot_stub_server.py
+        self.base_url_format = parameters.get('base_url', RiotAPI._base_url)
+        if self.base_url_format != RiotAPI._base_url:
+            self.logger.warning('Using RiotAPI at \'%s\'', self.base_url_format)
+        self.pool = RiotConnectionPool(
+            max_connections=parameters.get('max_connections_per_host', RiotConnectionPool.default_max_connections),
+            idle_timeout=parameters.get('idle_timeout', RiotConnectionPool.default_idle_timeout),
+            loop=loop)
+        self.rate_limiter = RiotRateLimiter(parameters.get('app_rate_limits', RiotRateLimiter.default_app_limits),
+                                            reserves=RiotAPI.priority_reserves(parameters), loop=loop)
+        # (region, normalized nickname) -> (summoner id, summoner name)
+        self.summoners_cache = TTLCache(
+            parameters.get('summoners_cache_size', RiotAPI.default_summoners_cache_size),
+            parameters.get('summoners_cache_ttl', RiotAPI.default_summoners_cache_ttl))
+        # (region, summoner id) -> list of league positions
+        self.positions_cache = StaleWhileRevalidateCache(
+            parameters.get('positions_cache_size', RiotAPI.default_positions_cache_size),
+            parameters.get('positions_fresh_ttl', RiotAPI.default_positions_fresh_ttl),
+            parameters.get('positions_stale_ttl', RiotAPI.default_positions_stale_ttl))
+        self._positions_refreshes = {}
+        self.requests = SingleFlight(loop=loop)
+        # Priorities of the requests in flight, by their SingleFlight key
+        self._tickets = {}
+        self.retry_policy = RetryPolicy(
+            attempts=parameters.get('retry_attempts', RetryPolicy.default_attempts),
+            base_delay=parameters.get('retry_base_delay', RetryPolicy.default_base_delay),
+            max_delay=parameters.get('retry_max_delay', RetryPolicy.default_max_delay),
+            deadline=parameters.get('retry_deadline', RetryPolicy.default_deadline))
+        self.circuit_breaker = CircuitBreaker(
+            failure_threshold=parameters.get('breaker_failure_threshold', CircuitBreaker.default_failure_threshold),
+            reset_timeout=parameters.get('breaker_reset_timeout', CircuitBreaker.default_reset_timeout))
+        # Region -> summoner id that resolved recently, to double check the by-id 404s
+        self._known_ids = {}
         # self.load_key(data_folder)
 
     @staticmethod
@@ -54,14 +117,25 @@ class RiotAPI:
         return region in RiotAPI._regions
 
     @staticmethod
-    def base_url(region):
+    def base_url(region, url_format=None):
         if RiotAPI.has_region(region):
             base_region = RiotAPI._regions[region]['base']
-            return RiotAPI._base_url.format(base_region)
+            return (url_format or RiotAPI._base_url).format(base_region)
         else:
             RiotAPI.logger.error('Requested unknown region for base_url: \'%s\'', region)
             return ''
 
+    @staticmethod
+    def host(region):
+        if RiotAPI.has_region(region):
+            return RiotAPI._regions[region]['base']
+        return ''
+
+    @staticmethod
+    def normalize_nickname(nickname):
+        # Riot ignores case and spaces in summoner names
+        return nickname.replace(' ', '').lower()
+
     @staticmethod
     def summoner_url(_):
         return RiotAPI._summoner_url
@@ -84,6 +158,17 @@ class RiotAPI:
             RiotAPI.logger.error('Requested unknown region for league_url: \'%s\'', region)
             return ''
 
+    @staticmethod
+    def priority_reserves(parameters):
+        defaults = RequestPriority.default_reserves
+        return {
+            RequestPriority.join: parameters.get('join_reserve', defaults[RequestPriority.join]),
+            RequestPriority.background: parameters.get('background_reserve', defaults[RequestPriority.background]),
+        }
+
+    def is_region_available(self, region):
+        return self.circuit_breaker.is_available(region)
+
     @property
     def api_key(self):
         return self._api_key
@@ -113,55 +198,175 @@ class RiotAPI:
             self.logger.error('Couldn\'t open riot api key file, create file with the api key in \'%s\'. Error: \'%s\'',
                               key_full_path, e)
 
-    def send_request(self, request_url, region):
-        content = None
+    @asyncio.coroutine
+    def close(self):
+        yield from self.pool.close()
+
+    @asyncio.coroutine
+    def send_request(self, request_url, region, method, priority=RequestPriority.interactive):
+        # Identical concurrent requests (e.g. a lot of '!elo' for the same name) share one Riot call,
+        # it waits for permits with the priority of the most important caller
+        key = (region, method, request_url)
+        ticket = self._tickets.get(key)
+        if ticket is None:
+            ticket = self._tickets[key] = PermitTicket(priority)
+        else:
+            self.rate_limiter.raise_priority(ticket, priority)
+        result = yield from self.requests.do(key, self._send_request, request_url, region, method, ticket)
+        return result
+
+    @asyncio.coroutine
+    def _send_request(self, request_url, region, method, ticket):
         try:
-            if not self.key_is_valid:
-                self.logger.error('Key is not set, ignoring request \'%s\'', request_url)
-                return content
-            url = RiotAPI.base_url(region) + request_url + self.riot_key_request
-            self.logger.debug('Sending request to: \'%s\'', url)
-            content = urllib.request.urlopen(url).read().decode()
-            return content, None
-        except urllib.error.HTTPError as e:
-            self.logger.error('Error while sending request to RiotAPI: %s', e)
-            return None, e.code
-
-    def get_summoner_data(self, region, user_id=None, nickname=None):
+            result = yield from self._send_attempts(request_url, region, method, ticket)
+        finally:
+            key = (region, method, request_url)
+            if self._tickets.get(key) is ticket:
+                del self._tickets[key]
+        return result
+
+    @asyncio.coroutine
+    def _send_attempts(self, request_url, region, method, ticket):
+        if not self.key_is_valid:
+            self.logger.error('Key is not set, ignoring request \'%s\'', request_url)
+            return None, None
+        url = RiotAPI.base_url(region, self.base_url_format) + request_url + self.riot_key_request
+
+        # Bounds the whole call: waiting for permits, the attempts and the sleeps between them
+        deadline = time.time() + self.retry_policy.deadline
+        attempt = 0
+        while True:
+            content, error_code, retry_after = yield from self._send_attempt(url, region, method, ticket, deadline)
+            if content is not None:
+                return content, None
+
+            delay = self.retry_policy.next_delay(error_code, attempt, deadline - time.time(), retry_after)
+            if delay is None:
+                return None, error_code
+            attempt += 1
+            self.logger.info('Retrying request \'%s\' after error %s in %.1fs (attempt %s)',
+                             request_url, error_code, delay, attempt + 1)
+            yield from asyncio.sleep(delay)
+
+    @asyncio.coroutine
+    def _send_attempt(self, url, region, method, ticket, deadline):
+        """Returns (content, error_code, retry_after)"""
+        if not self.circuit_breaker.allow_request(region):
+            self.logger.debug('RiotAPI for \'%s\' is down, not sending \'%s\'', region, url)
+            return None, RiotAPI.circuit_open_code, None
+
+        try:
+            yield from asyncio.wait_for(self.rate_limiter.acquire(region, method, ticket=ticket),
+                                        deadline - time.time())
+        except asyncio.TimeoutError:
+            self.logger.warning('No rate limit permit for \'%s\' before the deadline', url)
+            return None, RiotAPI.deadline_code, None
+
+        self.logger.debug('Sending request to: \'%s\'', url)
+        timeout = min(self.request_timeout, deadline - time.time())
+        try:
+            status, reason, headers, content = yield from asyncio.wait_for(
+                self.pool.get(RiotAPI.host(region), url), timeout)
+        except asyncio.TimeoutError as e:
+            if timeout < self.request_timeout:
+                # Cut short by the deadline, that's not the API being slow
+                self.logger.warning('Request \'%s\' ran out of time before the deadline', url)
+                return None, RiotAPI.deadline_code, None
+            self.logger.error('Error while sending request to RiotAPI: %s', repr(e))
+            self.circuit_breaker.record_failure(region)
+            return None, None, None
+        except aiohttp.ClientError as e:
+            self.logger.error('Error while sending request to RiotAPI: %s', repr(e))
+            self.circuit_breaker.record_failure(region)
+            return None, None, None
+
+        self.rate_limiter.update(region, method, status, headers)
+        self.record_health(region, method, status)
+        if status != 200:
+            self.logger.error('Error while sending request to RiotAPI: %s %s', status, reason)
+            retry_after = RiotRateLimiter.retry_after(headers) if 'Retry-After' in headers else None
+            return None, status, retry_after
+        return content, None, None
+
+    def record_health(self, region, method, status):
+        if status == 429:
+            # Being over the rate limit says nothing about the API health
+            return
+        if status == 404 and method == RiotAPI.summoner_by_id_method:
+            # Ids don't just disappear, so this one is judged by confirm_missing
+            return
+        if status >= 500 or status in (401, 403):
+            self.circuit_breaker.record_failure(region)
+        else:
+            self.circuit_breaker.record_success(region)
+
+    @asyncio.coroutine
+    def get_summoner_data(self, region, user_id=None, nickname=None, priority=RequestPriority.interactive):
         if user_id:
             api_url = '{0}{1}'.format(RiotAPI.summoner_url(region), user_id)
+            method = RiotAPI.summoner_by_id_method
         elif nickname:
+            cached_data = self.summoners_cache.get((region, RiotAPI.normalize_nickname(nickname)))
+            if cached_data:
+                return cached_data
             encoded_nickname = urllib.parse.quote(nickname.lower())
             api_url = '{0}by-name/{1}'.format(RiotAPI.summoner_url(region), encoded_nickname)
+            method = RiotAPI.summoner_by_name_method
         else:
             raise Exception('No user id or nickname provided for RiotAPI')
 
-        user_content, error_code = self.send_request(api_url, region)
+        user_content, error_code = yield from self.send_request(api_url, region, method, priority)
         if user_content is None:
             self.logger.info('Couldn\'t find user by \'{0}\' or id \'{1}\''.format(nickname, user_id).encode('utf-8'))
             if error_code == 404:
+                if user_id:
+                    is_missing = yield from self.confirm_missing(region, user_id, priority)
+                    if not is_missing:
+                        raise RiotAPI.RiotRequestException('Couldn\'t confirm that summoner id {0} is gone'
+                                                           .format(user_id), RiotAPI.unconfirmed_missing_code)
                 raise RiotAPI.UserIdNotFoundException('Couldn\'t find a username with nickname {0}'.format(nickname))
             else:
                 raise RiotAPI.RiotRequestException('Unknown request response error: {0}'.format(error_code), error_code)
 
         user_data_json = json.loads(user_content)
-        return user_data_json['id'], user_data_json['name'].strip()
+        summoner_data = user_data_json['id'], user_data_json['name'].strip()
+        self._known_ids[region] = summoner_data[0]
+        self.summoners_cache.set((region, RiotAPI.normalize_nickname(summoner_data[1])), summoner_data)
+        if nickname and not user_id:
+            self.summoners_cache.set((region, RiotAPI.normalize_nickname(nickname)), summoner_data)
+        return summoner_data
+
+    @asyncio.coroutine
+    def confirm_missing(self, region, user_id, priority):
+        """
+        Not found by id means clearing the stored user data, but a broken API answers 404 to everyone,
+        so it's trusted only if a summoner that resolved recently is still there
+        """
+        known_id = self._known_ids.get(region)
+        if known_id is None or known_id == user_id:
+            self._known_ids.pop(region, None)
+            return False
+        api_url = '{0}{1}'.format(RiotAPI.summoner_url(region), known_id)
+        content, error_code = yield from self.send_request(api_url, region, RiotAPI.summoner_by_id_method, priority)
+        if content is not None:
+            return True
+        if error_code == 404:
+            self.logger.warning('RiotAPI for \'%s\' can\'t find known summoner id %s either', region, known_id)
+            self.circuit_breaker.record_failure(region)
+        return False
 
-    def get_user_info(self, region, user_id=None, nickname=None):
+    @asyncio.coroutine
+    def get_user_info(self, region, user_id=None, nickname=None, priority=RequestPriority.interactive,
+                      fresh_only=False):
         self.logger.debug('Getting user elo for \'{0}\''.format(nickname).encode('utf-8'))
-        real_id, real_name = self.get_summoner_data(region, user_id=user_id, nickname=nickname)
+        real_id, real_name = yield from self.get_summoner_data(
+            region, user_id=user_id, nickname=nickname, priority=priority)
 
-        best_rank = 'unranked'
-        url = '{0}positions/by-summoner/{1}'.format(RiotAPI.league_url(region), real_id)
-        ranks_content, error_code = self.send_request(url, region)
-        if not ranks_content:
-            raise RiotAPI.RiotRequestException('Error while getting leagues data for {0}: {1}'
-                                               .format(real_name, error_code), error_code)
+        ranks_data = yield from self.get_positions(region, real_id, real_name, priority, fresh_only)
 
+        best_rank = 'unranked'
         best_rank_id = RiotAPI.ranks[best_rank]
 
-        ranks_data = json.loads(ranks_content)
-        # game_modes = ranks_data[user_id_str]
         for mode in ranks_data:
             queue = mode['queueType']
             if queue != 'RANKED_SOLO_5x5' and queue != 'RANKED_FLEX_SR':
@@ -173,11 +378,58 @@ class RiotAPI:
                 best_rank_id = rank_id
         return best_rank, real_id, real_name
 
-    def check_user_verification(self, summoner_id, required_code, region):
+    @asyncio.coroutine
+    def get_positions(self, region, summoner_id, summoner_name, priority=RequestPriority.interactive,
+                      fresh_only=False):
+        """
+        Stale positions are answered right away and refreshed in background, fresh_only waits for the new ones
+        instead: autoupdate refreshes less often than the data gets stale, so it would always apply old ranks
+        """
+        key = (region, summoner_id)
+        cached_positions = self.positions_cache.get(key)
+        if cached_positions is not None:
+            positions, is_fresh = cached_positions
+            if is_fresh:
+                return positions
+            if not fresh_only:
+                self.refresh_positions(region, summoner_id, summoner_name)
+                return positions
+        positions = yield from self.request_positions(region, summoner_id, summoner_name, priority)
+        return positions
+
+    def refresh_positions(self, region, summoner_id, summoner_name):
+        """Updates stale cached positions in background, the caller keeps using the stale ones"""
+        key = (region, summoner_id)
+        if key in self._positions_refreshes:
+            return
+        task = asyncio.ensure_future(self._refresh_positions(region, summoner_id, summoner_name), loop=self.loop)
+        self._positions_refreshes[key] = task
+        task.add_done_callback(lambda _: self._positions_refreshes.pop(key, None))
+
+    @asyncio.coroutine
+    def _refresh_positions(self, region, summoner_id, summoner_name):
+        try:
+            yield from self.request_positions(region, summoner_id, summoner_name, RequestPriority.background)
+        except RiotAPI.RiotRequestException as e:
+            self.logger.warning('Couldn\'t refresh leagues data for \'%s\': %s', summoner_name, e.error_code)
+
+    @asyncio.coroutine
+    def request_positions(self, region, summoner_id, summoner_name, priority):
+        url = '{0}positions/by-summoner/{1}'.format(RiotAPI.league_url(region), summoner_id)
+        ranks_content, error_code = yield from self.send_request(url, region, RiotAPI.positions_method, priority)
+        if not ranks_content:
+            raise RiotAPI.RiotRequestException('Error while getting leagues data for {0}: {1}'
+                                               .format(summoner_name, error_code), error_code)
+        positions = json.loads(ranks_content)
+        self.positions_cache.set((region, summoner_id), positions)
+        return positions
+
+    @asyncio.coroutine
+    def check_user_verification(self, summoner_id, required_code, region, priority=RequestPriority.interactive):
         required_code = required_code.strip()
         url = '{0}/{1}'.format(RiotAPI.confirm_url(region), summoner_id)
-        response, error_code = self.send_request(url, region)
-        if error_code:
+        response, error_code = yield from self.send_request(url, region, RiotAPI.confirm_method, priority)
+        if response is None:
             return False, 'Error: {0}'.format(error_code)
         else:
             response_code = response[1:-1].strip()
@@ -0,0 +1,94 @@
+import time
+import logging
+import asyncio
+import aiohttp
+
+
+class RiotConnectionPool:
+    """Keeps one keep-alive aiohttp session per Riot platform host"""
+    logger = logging.getLogger(__name__)
+
+    default_max_connections = 10
+    default_idle_timeout = 30
+
+    def __init__(self, max_connections=default_max_connections, idle_timeout=default_idle_timeout, loop=None):
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self.loop = loop
+        self._sessions = {}
+        self._stats = {}
+
+    def session(self, host):
+        session = self._sessions.get(host)
+        if session is None or session.closed:
+            self.logger.info('Opening connection pool for \'%s\' (max %s connections, idle timeout %ss)',
+                             host, self.max_connections, self.idle_timeout)
+            connector = aiohttp.TCPConnector(
+                limit=self.max_connections, keepalive_timeout=self.idle_timeout, loop=self.loop)
+            session = aiohttp.ClientSession(connector=connector, loop=self.loop)
+            self._sessions[host] = session
+            self.host_stats(host).sessions_opened += 1
+        return session
+
+    def host_stats(self, host):
+        stats = self._stats.get(host)
+        if stats is None:
+            stats = self._stats[host] = HostStats(host)
+        return stats
+
+    @property
+    def stats(self):
+        return [self._stats[host] for host in sorted(self._stats)]
+
+    @asyncio.coroutine
+    def get(self, host, url):
+        """Returns (status, reason, headers, content) for the url, content is only read on success"""
+        stats = self.host_stats(host)
+        stats.requests += 1
+        stats.active += 1
+        stats.peak_active = max(stats.peak_active, stats.active)
+        start_time = time.time()
+        try:
+            response = yield from self.session(host).get(url)
+            try:
+                content = None
+                if response.status == 200:
+                    content = yield from response.text()
+                return response.status, response.reason, response.headers, content
+            finally:
+                response.release()
+        except Exception:
+            stats.errors += 1
+            raise
+        finally:
+            stats.active -= 1
+            stats.total_time += time.time() - start_time
+
+    @asyncio.coroutine
+    def close(self):
+        for host, session in self._sessions.items():
+            if not session.closed:
+                self.logger.info('Closing connection pool for \'%s\'', host)
+                session.close()
+        self._sessions.clear()
+
+
+class HostStats:
+    def __init__(self, host):
+        self.host = host
+        self.sessions_opened = 0
+        self.requests = 0
+        self.errors = 0
+        self.active = 0
+        self.peak_active = 0
+        self.total_time = 0.0
+
+    @property
+    def average_time(self):
+        finished = self.requests - self.active
+        return self.total_time / finished if finished > 0 else 0.0
+
+    def __str__(self):
+        return '{0}: {1} requests ({2} errors), {3} active (peak {4}), avg {5:.0f}ms, {6} sessions opened'\
+            .format(self.host, self.requests, self.errors, self.active, self.peak_active,
+                    self.average_time * 1000, self.sessions_opened)
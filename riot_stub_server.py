@@ -0,0 +1,341 @@
+"""
+Local stand-in for the RiotAPI endpoints used by the bot, serving summoners, league positions
+and verification codes from a fixtures file.
+
+Serve fixtures (point the bot to it with "base_url": "http://127.0.0.1:8090/{0}/" in the 'riot' parameters):
+    python3 riot_stub_server.py serve Data_Example/riot_fixtures.json --latency 0.05 --error-rate 0.01
+Record real responses into fixtures:
+    python3 riot_stub_server.py record fixtures.json --key RGAPI-... --region euw Xorboo "Some Name"
+Measure RiotAPI throughput against a running stub:
+    python3 riot_stub_server.py bench Data_Example/riot_fixtures.json --requests 1000 --concurrency 50
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import logging
+import asyncio
+import argparse
+import urllib.parse
+from aiohttp import web
+from riot import RiotAPI
+
+
+class RiotFixtures:
+    """Fixtures file: {platform: {'summoners': {id: summoner}, 'positions': {id: [...]}, 'codes': {id: code}}}"""
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.platforms = {}
+        self._names = {}
+        if os.path.exists(file_path):
+            with open(file_path, encoding='utf-8') as fixtures_file:
+                self.platforms = json.load(fixtures_file)
+        self.build_index()
+
+    def build_index(self):
+        self._names = {}
+        for platform, data in self.platforms.items():
+            for summoner in data.get('summoners', {}).values():
+                self._names[(platform, RiotAPI.normalize_nickname(summoner['name']))] = summoner
+
+    def platform(self, platform):
+        data = self.platforms.setdefault(platform, {})
+        for section in ('summoners', 'positions', 'codes'):
+            data.setdefault(section, {})
+        return data
+
+    def summoner_by_name(self, platform, name):
+        return self._names.get((platform, RiotAPI.normalize_nickname(name)))
+
+    def summoner_by_id(self, platform, summoner_id):
+        return self.platforms.get(platform, {}).get('summoners', {}).get(str(summoner_id))
+
+    def positions(self, platform, summoner_id):
+        return self.platforms.get(platform, {}).get('positions', {}).get(str(summoner_id))
+
+    def code(self, platform, summoner_id):
+        return self.platforms.get(platform, {}).get('codes', {}).get(str(summoner_id))
+
+    def add(self, platform, summoner, positions=None, code=None):
+        data = self.platform(platform)
+        summoner_id = str(summoner['id'])
+        data['summoners'][summoner_id] = summoner
+        if positions is not None:
+            data['positions'][summoner_id] = positions
+        if code is not None:
+            data['codes'][summoner_id] = code
+        self.build_index()
+
+    def save(self):
+        with open(self.file_path, 'w', encoding='utf-8') as fixtures_file:
+            json.dump(self.platforms, fixtures_file, indent=2, ensure_ascii=False, sort_keys=True)
+        self.logger.info('Saved fixtures to \'%s\'', self.file_path)
+
+    @property
+    def summoners(self):
+        return [(platform, summoner) for platform, data in sorted(self.platforms.items())
+                for summoner in data.get('summoners', {}).values()]
+
+
+class StubRateLimits:
+    """Fixed-window counters returning the same rate limit headers Riot does"""
+
+    def __init__(self, app_limits, method_limits):
+        self.app_limits = app_limits
+        self.method_limits = method_limits
+        self._windows = {}
+
+    @staticmethod
+    def parse(text):
+        return [tuple(int(x) for x in part.split(':')) for part in text.split(',') if part.strip()]
+
+    def _count(self, key, limits_text, now):
+        """Counts the request in all windows, returns (counts header, retry_after if over the limit)"""
+        counts = []
+        retry_after = None
+        for limit, window in StubRateLimits.parse(limits_text):
+            window_key = (key, window)
+            start, count = self._windows.get(window_key, (now, 0))
+            if now - start >= window:
+                start, count = now, 0
+            count += 1
+            self._windows[window_key] = (start, count)
+            counts.append('{0}:{1}'.format(count, window))
+            if count > limit:
+                retry_after = max(retry_after or 0, int(start + window - now) + 1)
+        return ','.join(counts), retry_after
+
+    def check(self, platform, method):
+        """Returns (headers, limit type if the request is over the limit, retry_after)"""
+        now = time.time()
+        headers = {}
+        app_counts, app_retry = self._count(platform, self.app_limits, now)
+        method_counts, method_retry = self._count((platform, method), self.method_limits, now)
+        headers['X-App-Rate-Limit'] = self.app_limits
+        headers['X-App-Rate-Limit-Count'] = app_counts
+        headers['X-Method-Rate-Limit'] = self.method_limits
+        headers['X-Method-Rate-Limit-Count'] = method_counts
+        if app_retry:
+            return headers, 'application', app_retry
+        if method_retry:
+            return headers, 'method', method_retry
+        return headers, None, None
+
+
+class RiotStubServer:
+    logger = logging.getLogger(__name__)
+
+    default_host = '127.0.0.1'
+    default_port = 8090
+
+    def __init__(self, fixtures, latency=0.0, latency_jitter=0.0, error_rate=0.0, error_codes=(500, 503),
+                 app_limits='', method_limits='', loop=None):
+        self.fixtures = fixtures
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate
+        self.error_codes = error_codes
+        self.rate_limits = StubRateLimits(app_limits, method_limits) if app_limits or method_limits else None
+        self.requests = 0
+        self.app = web.Application(loop=loop)
+        router = self.app.router
+        router.add_route('GET', '/{platform}/lol/summoner/v3/summoners/by-name/{name}', self.summoner_by_name)
+        router.add_route('GET', '/{platform}/lol/summoner/v3/summoners/{summoner_id}', self.summoner_by_id)
+        router.add_route('GET', '/{platform}/lol/league/v3/positions/by-summoner/{summoner_id}', self.positions)
+        router.add_route('GET', '/{platform}/lol/platform/v3/third-party-code/by-summoner/{summoner_id}', self.code)
+
+    @asyncio.coroutine
+    def respond(self, request, method, data):
+        self.requests += 1
+        delay = self.latency + random.uniform(0, self.latency_jitter)
+        if delay > 0:
+            yield from asyncio.sleep(delay)
+
+        headers = {}
+        if self.rate_limits:
+            headers, limit_type, retry_after = self.rate_limits.check(request.match_info['platform'], method)
+            if limit_type:
+                headers['X-Rate-Limit-Type'] = limit_type
+                headers['Retry-After'] = str(retry_after)
+                return web.Response(status=429, headers=headers, text='{"status": {"status_code": 429}}',
+                                    content_type='application/json')
+
+        if 'api_key' not in request.GET:
+            return web.Response(status=401, headers=headers, text='{"status": {"status_code": 401}}',
+                                content_type='application/json')
+        if self.error_rate and random.random() < self.error_rate:
+            status = random.choice(self.error_codes)
+            return web.Response(status=status, headers=headers, text='{{"status": {{"status_code": {0}}}}}'
+                                .format(status), content_type='application/json')
+        if data is None:
+            return web.Response(status=404, headers=headers, text='{"status": {"status_code": 404}}',
+                                content_type='application/json')
+        return web.Response(headers=headers, text=json.dumps(data), content_type='application/json')
+
+    @asyncio.coroutine
+    def summoner_by_name(self, request):
+        summoner = self.fixtures.summoner_by_name(request.match_info['platform'], request.match_info['name'])
+        response = yield from self.respond(request, RiotAPI.summoner_by_name_method, summoner)
+        return response
+
+    @asyncio.coroutine
+    def summoner_by_id(self, request):
+        summoner = self.fixtures.summoner_by_id(request.match_info['platform'], request.match_info['summoner_id'])
+        response = yield from self.respond(request, RiotAPI.summoner_by_id_method, summoner)
+        return response
+
+    @asyncio.coroutine
+    def positions(self, request):
+        platform, summoner_id = request.match_info['platform'], request.match_info['summoner_id']
+        positions = self.fixtures.positions(platform, summoner_id)
+        # Riot returns an empty list for existing summoners without ranked games
+        if positions is None and self.fixtures.summoner_by_id(platform, summoner_id):
+            positions = []
+        response = yield from self.respond(request, RiotAPI.positions_method, positions)
+        return response
+
+    @asyncio.coroutine
+    def code(self, request):
+        code = self.fixtures.code(request.match_info['platform'], request.match_info['summoner_id'])
+        response = yield from self.respond(request, RiotAPI.confirm_method, code)
+        return response
+
+
+class RiotRecorder:
+    """Captures real RiotAPI responses into fixtures"""
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, riot_api, fixtures):
+        self.riot_api = riot_api
+        self.fixtures = fixtures
+
+    @asyncio.coroutine
+    def record(self, region, nickname):
+        platform = RiotAPI.host(region)
+        url = '{0}by-name/{1}'.format(RiotAPI.summoner_url(region), urllib.parse.quote(nickname.lower()))
+        content, error_code = yield from self.riot_api.send_request(url, region, RiotAPI.summoner_by_name_method)
+        if content is None:
+            self.logger.error('Couldn\'t record \'%s\' on \'%s\': %s', nickname, region, error_code)
+            return False
+        summoner = json.loads(content)
+
+        url = '{0}positions/by-summoner/{1}'.format(RiotAPI.league_url(region), summoner['id'])
+        content, error_code = yield from self.riot_api.send_request(url, region, RiotAPI.positions_method)
+        positions = json.loads(content) if content is not None else None
+
+        url = '{0}/{1}'.format(RiotAPI.confirm_url(region), summoner['id'])
+        content, error_code = yield from self.riot_api.send_request(url, region, RiotAPI.confirm_method)
+        code = json.loads(content) if content is not None else None
+
+        self.fixtures.add(platform, summoner, positions, code)
+        self.logger.info('Recorded \'%s\' (%s) on \'%s\'', summoner['name'], summoner['id'], platform)
+        return True
+
+
+@asyncio.coroutine
+def run_benchmark(riot_api, names, total_requests, concurrency):
+    """Runs get_user_info for the names in a loop, returns (requests done, errors, seconds)"""
+    errors = 0
+    next_index = 0
+
+    @asyncio.coroutine
+    def worker():
+        nonlocal errors, next_index
+        while next_index < total_requests:
+            region, name = names[next_index % len(names)]
+            next_index += 1
+            try:
+                yield from riot_api.get_user_info(region, nickname=name)
+            except (RiotAPI.UserIdNotFoundException, RiotAPI.RiotRequestException):
+                errors += 1
+
+    start_time = time.time()
+    yield from asyncio.gather(*[worker() for _ in range(concurrency)])
+    return total_requests, errors, time.time() - start_time
+
+
+def platform_region(platform):
+    return next((r for r in RiotAPI._regions if RiotAPI.host(r) == platform), None)
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s %(levelname)s: %(message)s')
+    parser = argparse.ArgumentParser(description='Local RiotAPI stand-in server')
+    commands = parser.add_subparsers(dest='command')
+
+    serve = commands.add_parser('serve', help='serve fixtures over http')
+    serve.add_argument('fixtures')
+    serve.add_argument('--host', default=RiotStubServer.default_host)
+    serve.add_argument('--port', type=int, default=RiotStubServer.default_port)
+    serve.add_argument('--latency', type=float, default=0.0, help='seconds added to every response')
+    serve.add_argument('--latency-jitter', type=float, default=0.0, help='random extra latency up to this')
+    serve.add_argument('--error-rate', type=float, default=0.0, help='part of requests failing with an error')
+    serve.add_argument('--error-codes', default='500,503')
+    serve.add_argument('--app-limits', default='', help='application rate limits, e.g. 20:1,100:120')
+    serve.add_argument('--method-limits', default='', help='method rate limits, e.g. 1000:10')
+
+    record = commands.add_parser('record', help='record real RiotAPI responses into fixtures')
+    record.add_argument('fixtures')
+    record.add_argument('names', nargs='+')
+    record.add_argument('--key', required=True)
+    record.add_argument('--region', default='euw')
+
+    bench = commands.add_parser('bench', help='measure RiotAPI throughput against the stub server')
+    bench.add_argument('fixtures')
+    bench.add_argument('--url', default='http://{0}:{1}/{{0}}/'.format(
+        RiotStubServer.default_host, RiotStubServer.default_port))
+    bench.add_argument('--requests', type=int, default=1000)
+    bench.add_argument('--concurrency', type=int, default=20)
+    bench.add_argument('--app-limits', default='100000:1')
+    bench.add_argument('--no-cache', action='store_true', help='disable summoners and positions caches')
+
+    args = parser.parse_args()
+    loop = asyncio.get_event_loop()
+    fixtures = RiotFixtures(args.fixtures)
+
+    if args.command == 'serve':
+        server = RiotStubServer(fixtures, latency=args.latency, latency_jitter=args.latency_jitter,
+                                error_rate=args.error_rate,
+                                error_codes=[int(c) for c in args.error_codes.split(',')],
+                                app_limits=args.app_limits, method_limits=args.method_limits, loop=loop)
+        logging.info('Serving %s summoners from \'%s\'', len(fixtures.summoners), args.fixtures)
+        web.run_app(server.app, host=args.host, port=args.port)
+
+    elif args.command == 'record':
+        riot_api = RiotAPI(args.key, loop=loop)
+        recorder = RiotRecorder(riot_api, fixtures)
+        try:
+            for name in args.names:
+                loop.run_until_complete(recorder.record(args.region, name))
+            fixtures.save()
+        finally:
+            loop.run_until_complete(riot_api.close())
+
+    elif args.command == 'bench':
+        names = [(platform_region(platform), summoner['name']) for platform, summoner in fixtures.summoners]
+        names = [n for n in names if n[0]]
+        if not names:
+            logging.error('No summoners in \'%s\' to benchmark with', args.fixtures)
+            sys.exit(1)
+        parameters = {'base_url': args.url, 'app_rate_limits': args.app_limits}
+        if args.no_cache:
+            parameters.update({'summoners_cache_size': 0, 'positions_cache_size': 0})
+        riot_api = RiotAPI('stub-key', parameters, loop=loop)
+        try:
+            done, errors, seconds = loop.run_until_complete(
+                run_benchmark(riot_api, names, args.requests, args.concurrency))
+            logging.info('%s get_user_info calls in %.2fs: %.0f/s, %s errors', done, seconds, done / seconds, errors)
+            for stats in riot_api.pool.stats:
+                logging.info('%s', stats)
+        finally:
+            loop.run_until_complete(riot_api.close())
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
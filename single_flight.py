@@ -0,0 +1,36 @@
+import asyncio
+
+
+class SingleFlight:
+    """Runs only one coroutine per key at a time, concurrent callers with the same key share its result"""
+
+    def __init__(self, loop=None):
+        self.loop = loop
+        self._calls = {}
+        self.started = 0
+        self.shared = 0
+
+    @asyncio.coroutine
+    def do(self, key, coroutine_function, *args):
+        future = self._calls.get(key)
+        if future is None:
+            self.started += 1
+            future = asyncio.ensure_future(coroutine_function(*args), loop=self.loop)
+            self._calls[key] = future
+            future.add_done_callback(lambda f: self._forget(key, f))
+        else:
+            self.shared += 1
+        # Shielded, so a cancelled caller doesn't cancel the call for everyone else
+        result = yield from asyncio.shield(future)
+        return result
+
+    def _forget(self, key, future):
+        if self._calls.get(key) is future:
+            del self._calls[key]
+
+    @property
+    def in_flight(self):
+        return len(self._calls)
+
+    def __str__(self):
+        return '{0} calls, {1} coalesced, {2} in flight'.format(self.started, self.shared, self.in_flight)
@@ -0,0 +1,13 @@
+import os
+import sys
+import asyncio
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def run():
+    """Runs a coroutine to the end on the default event loop"""
+    loop = asyncio.get_event_loop()
+    return loop.run_until_complete
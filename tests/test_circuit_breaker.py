@@ -0,0 +1,55 @@
+import pytest
+import circuit_breaker
+from circuit_breaker import CircuitBreaker
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(circuit_breaker.time, 'time', lambda: now[0])
+    return now
+
+
+def test_opens_after_failures_in_a_row(clock):
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=60)
+    breaker.record_failure('euw')
+    breaker.record_failure('euw')
+    breaker.record_success('euw')
+    breaker.record_failure('euw')
+    breaker.record_failure('euw')
+    assert breaker.state('euw') == CircuitBreaker.closed
+
+    breaker.record_failure('euw')
+    assert breaker.state('euw') == CircuitBreaker.open
+    assert not breaker.allow_request('euw')
+    assert breaker.retry_in('euw') == 60
+    assert breaker.is_available('eune')
+
+
+def test_half_open_lets_one_probe_through(clock):
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=60)
+    breaker.record_failure('euw')
+    clock[0] += 60
+    assert breaker.state('euw') == CircuitBreaker.half_open
+    assert breaker.allow_request('euw')
+    assert not breaker.allow_request('euw')
+
+    # The probe got lost
+    clock[0] += 61
+    assert breaker.allow_request('euw')
+
+
+def test_probe_result_closes_or_reopens(clock):
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=60)
+    breaker.record_failure('euw')
+    clock[0] += 60
+    assert breaker.allow_request('euw')
+    breaker.record_failure('euw')
+    assert breaker.state('euw') == CircuitBreaker.open
+    assert breaker.retry_in('euw') == 60
+
+    clock[0] += 60
+    assert breaker.allow_request('euw')
+    breaker.record_success('euw')
+    assert breaker.state('euw') == CircuitBreaker.closed
+    assert breaker.allow_request('euw')
@@ -0,0 +1,48 @@
+import asyncio
+from rate_limiter import RiotRateLimiter, RequestPriority, PermitTicket
+
+
+def queue_requests(limiter, requests, granted):
+    @asyncio.coroutine
+    def request(name, priority, ticket):
+        yield from limiter.acquire('euw', 'method', priority, ticket=ticket)
+        granted.append(name)
+    return [asyncio.ensure_future(request(*r)) for r in requests]
+
+
+def test_permits_go_to_the_most_important_first(run):
+    limiter = RiotRateLimiter('1:100', reserves={RequestPriority.join: 0, RequestPriority.background: 0})
+    run(limiter.acquire('euw', 'method'))
+    granted = []
+    tasks = queue_requests(limiter, [('background', RequestPriority.background, None),
+                                     ('join', RequestPriority.join, None),
+                                     ('interactive', RequestPriority.interactive, None)], granted)
+    run(asyncio.sleep(0))
+    assert 'euw queue: 1 interactive, 1 join, 1 background' in limiter.stats
+
+    # A new window for each of them
+    for _ in tasks:
+        limiter.app_limit('euw').buckets[0].window_start -= 100
+        limiter._dispatch('euw')
+        run(asyncio.sleep(0))
+    assert granted == ['interactive', 'join', 'background']
+
+
+def test_raised_priority_moves_the_waiter_ahead(run):
+    limiter = RiotRateLimiter('1:100', reserves={RequestPriority.join: 0, RequestPriority.background: 0})
+    run(limiter.acquire('euw', 'method'))
+    granted = []
+    ticket = PermitTicket(RequestPriority.background)
+    tasks = queue_requests(limiter, [('join', RequestPriority.join, None),
+                                     ('shared', RequestPriority.background, ticket)], granted)
+    run(asyncio.sleep(0))
+    limiter.raise_priority(ticket, RequestPriority.interactive)
+    assert 'euw queue: 1 interactive, 1 join, 0 background' in limiter.stats
+
+    for _ in tasks:
+        limiter.app_limit('euw').buckets[0].window_start -= 100
+        limiter._dispatch('euw')
+        run(asyncio.sleep(0))
+    assert granted == ['shared', 'join']
+    assert len(limiter._waits[RequestPriority.interactive]) == 2
+    assert len(limiter._waits[RequestPriority.background]) == 0
@@ -0,0 +1,16 @@
+from retry_policy import RetryPolicy
+
+
+def test_retries_only_transient_errors():
+    policy = RetryPolicy(attempts=3, base_delay=0.5)
+    assert policy.next_delay(404, 0, 20) is None
+    assert 0 <= policy.next_delay(503, 0, 20) <= 0.5
+    assert policy.next_delay(None, 1, 20) <= 1
+    assert policy.next_delay(503, 2, 20) is None
+
+
+def test_stops_when_the_backoff_outlives_the_deadline():
+    policy = RetryPolicy(attempts=5)
+    assert policy.next_delay(429, 0, 20, retry_after=5) == 5
+    assert policy.next_delay(429, 0, 4, retry_after=5) is None
+    assert policy.gave_up == 1
@@ -0,0 +1,61 @@
+import json
+import time
+import asyncio
+import pytest
+from riot import RiotAPI
+from circuit_breaker import CircuitBreaker
+
+
+def summoner(summoner_id):
+    return json.dumps({'id': summoner_id, 'name': 'Summoner{0}'.format(summoner_id)})
+
+
+@pytest.fixture
+def api(monkeypatch):
+    api = RiotAPI('key', {'breaker_failure_threshold': 2})
+    api.existing_ids = {1, 2}
+    api.sent = []
+
+    @asyncio.coroutine
+    def send_request(request_url, region, method, priority):
+        summoner_id = int(request_url.rsplit('/', 1)[1])
+        api.sent.append(summoner_id)
+        if summoner_id in api.existing_ids:
+            return summoner(summoner_id), None
+        return None, 404
+
+    monkeypatch.setattr(api, 'send_request', send_request)
+    return api
+
+
+def test_missing_id_is_confirmed_by_a_known_one(api, run):
+    assert run(api.get_summoner_data('euw', user_id=1)) == (1, 'Summoner1')
+    with pytest.raises(RiotAPI.UserIdNotFoundException):
+        run(api.get_summoner_data('euw', user_id=3))
+    assert api.sent == [1, 3, 1]
+
+
+def test_missing_id_without_a_known_one_is_not_trusted(api, run):
+    with pytest.raises(RiotAPI.RiotRequestException) as e:
+        run(api.get_summoner_data('euw', user_id=3))
+    assert e.value.error_code == RiotAPI.unconfirmed_missing_code
+
+
+def test_everyone_missing_opens_the_circuit(api, run):
+    run(api.get_summoner_data('euw', user_id=1))
+    api.existing_ids.clear()
+    for summoner_id in (2, 3):
+        with pytest.raises(RiotAPI.RiotRequestException) as e:
+            run(api.get_summoner_data('euw', user_id=summoner_id))
+        assert e.value.error_code == RiotAPI.unconfirmed_missing_code
+    assert api.circuit_breaker.state('euw') == CircuitBreaker.open
+
+
+def test_permit_wait_is_bound_by_the_deadline(run):
+    api = RiotAPI('key', {'app_rate_limits': '1:100', 'retry_deadline': 0.1})
+    run(api.rate_limiter.acquire('euw', RiotAPI.summoner_by_id_method))
+    start_time = time.time()
+    content, error_code = run(api.send_request('summoner/1', 'euw', RiotAPI.summoner_by_id_method))
+    assert (content, error_code) == (None, RiotAPI.deadline_code)
+    assert time.time() - start_time < 1
+    assert all(waiter.done() for _, _, _, waiter in api.rate_limiter._queues['euw'])
@@ -0,0 +1,163 @@
+import json
+import asyncio
+import types
+import pytest
+import users
+import users_storage
+from users import Users, ServersData
+
+
+def member(server_id, discord_id):
+    return types.SimpleNamespace(id=discord_id, server=types.SimpleNamespace(id=server_id))
+
+
+def reload(folder, engine, run, data_users):
+    run(data_users.flush())
+    data_users.close()
+    return Users(folder, {'engine': engine})
+
+
+def legacy_user(discord_id, game_id, nickname):
+    # Written before UserData had __getstate__, jsonpickle restores it attribute by attribute
+    return {'py/object': 'users.UserData', 'discord_id': discord_id, 'rank': 'gold', 'game_id': game_id,
+            'nickname': nickname, 'confirmed': False, 'cancer': False}
+
+
+def test_legacy_load_keeps_nickname_of_the_first_membership(tmpdir):
+    legacy = {'py/object': 'users.ServersData', 'servers': [
+        {'py/object': 'users.ServerData', 'server_id': 's1', 'users': [legacy_user('d1', 42, 'Foo')]},
+        {'py/object': 'users.ServerData', 'server_id': 's2', 'users': [legacy_user('d1', 42, 'Bar')]}]}
+    tmpdir.join(users_storage.JsonPickleStorage.file_name).write(json.dumps(legacy))
+
+    data = Users(str(tmpdir), {'engine': 'json'}).data
+    first, second = data.get_server('s1').get_user('d1'), data.get_server('s2').get_user('d1')
+    assert first.account is second.account
+    assert first.nickname == second.nickname == 'Foo'
+    assert data.get_server('s2')._nicknames_index == {'foo': 'd1'}
+
+
+def test_single_membership_has_no_account():
+    data = ServersData([])
+    server = data.create_server('s1')
+    data.set_user_game_data(server, server.create_user('d1'), 42, 'Foo')
+    assert server.get_user('d1').account is None
+
+
+def test_rename_reaches_every_membership():
+    data = ServersData([])
+    servers = [data.create_server(server_id) for server_id in ('s1', 's2', 's3')]
+    for server in servers:
+        data.set_user_game_data(server, server.create_user('d1'), 42, 'Old Name')
+    renamed = data.set_user_game_data(servers[0], servers[0].get_user('d1'), 42, 'New Name')
+    assert len(renamed) == 3
+    for server in servers:
+        assert server.get_user('d1').nickname == 'New Name'
+        assert server._nicknames_index == {'newname': 'd1'}
+
+
+def test_new_game_id_leaves_the_shared_account():
+    data = ServersData([])
+    first, second = data.create_server('s1'), data.create_server('s2')
+    data.set_user_game_data(first, first.create_user('d1'), 42, 'Foo')
+    data.set_user_game_data(second, second.create_user('d1'), 42, 'Foo')
+    data.set_user_game_data(second, second.get_user('d1'), 43, 'Other')
+    assert first.get_user('d1').nickname == 'Foo'
+    assert second.get_user('d1').account is None
+    assert second.get_user('d1').game_id == 43
+
+
+@pytest.mark.parametrize('engine', sorted(users_storage.engines))
+def test_storage_round_trip(tmpdir, run, engine):
+    folder = str(tmpdir)
+    data_users = Users(folder, {'engine': engine})
+    for server_id in ('s1', 's2'):
+        server = data_users.get_or_create_server(server_id)
+        data_users.update_user(server, server.get_or_create_user('d1'), 42, 'Old Name', 'gold')
+    data_users.set_user_nickname(member('s1', 'd2'), 'Somebody')
+    data_users.set_server_region('s2', 'na')
+    data_users.set_member_ban('d3')
+    data_users.set_server_departed('s2')
+    first = data_users.data.get_server('s1')
+    data_users.update_user(first, first.get_user('d1'), 42, 'New Name', 'platinum')
+
+    data = reload(folder, engine, run, data_users).data
+    first, second = data.get_server('s1'), data.get_server('s2')
+    assert first.get_user('d1').nickname == second.get_user('d1').nickname == 'New Name'
+    assert first.get_user('d1').account is second.get_user('d1').account
+    assert (first.get_user('d1').rank, second.get_user('d1').rank) == ('platinum', 'gold')
+    assert first.get_user('d2').nickname == 'Somebody'
+    assert second.parameters.get_region() == 'na'
+    assert data.is_member_banned('d3')
+    assert 's2' in data.departed
+
+
+def test_shard_loaded_later_does_not_rename_the_account(tmpdir, run):
+    folder = str(tmpdir)
+    data_users = Users(folder, {'engine': 'sharded'})
+    for server_id in ('s1', 's2'):
+        server = data_users.get_or_create_server(server_id)
+        data_users.update_user(server, server.get_or_create_user('d1'), 42, 'Old Name', 'gold')
+    run(data_users.flush())
+    # s2 is saved with the old name and unloaded while the account is renamed
+    data_users.data.evict_server('s2')
+    first = data_users.data.get_server('s1')
+    data_users.update_user(first, first.get_user('d1'), 42, 'New Name', 'gold')
+    second = data_users.data.get_server('s2')
+    assert second.get_user('d1').nickname == 'New Name'
+    assert second._nicknames_index == {'newname': 'd1'}
+
+
+def test_failed_shard_write_is_marked_dirty_again(tmpdir, run, monkeypatch):
+    data_users = Users(str(tmpdir), {'engine': 'sharded'})
+    for server_id in ('s1', 's2'):
+        server = data_users.get_or_create_server(server_id)
+        data_users.update_user(server, server.get_or_create_user('d1'), 42, 'Name', 'gold')
+    run(data_users.flush())
+    data_users.remove_server('s2')
+    server = data_users.data.get_server('s1')
+    data_users.update_user(server, server.get_user('d1'), 42, 'Name', 'platinum')
+
+    def broken_write(path, contents):
+        raise IOError('disk is full')
+    monkeypatch.setattr(users_storage, 'atomic_write', broken_write)
+    run(data_users.start_save())
+    # The storage gets the unsaved servers back on the event loop
+    run(asyncio.sleep(0))
+    assert data_users.storage.dirty_servers == {'s1'}
+    assert data_users.storage.removed_servers == {'s2'}
+    assert data_users.is_dirty
+
+
+def test_journal_replays_renames_in_order(tmpdir):
+    folder = str(tmpdir)
+    data_users = Users(folder, {'engine': 'journal'})
+    for server_id in ('s1', 's2'):
+        server = data_users.get_or_create_server(server_id)
+        data_users.update_user(server, server.get_or_create_user('d1'), 42, 'Old Name', 'gold')
+    second = data_users.data.get_server('s2')
+    data_users.update_user(second, second.get_user('d1'), 42, 'New Name', 'gold')
+    data_users.close()
+
+    data = Users(folder, {'engine': 'journal'}).data
+    assert data.get_server('s1').get_user('d1').nickname == 'New Name'
+    assert users.RiotAPI.normalize_nickname('New Name') in data.get_server('s1')._nicknames_index
+
+
+def test_journal_survives_a_torn_record(tmpdir):
+    folder = str(tmpdir)
+    data_users = Users(folder, {'engine': 'journal'})
+    server = data_users.get_or_create_server('s1')
+    data_users.update_user(server, server.get_or_create_user('d1'), 42, 'Name', 'gold')
+    data_users.close()
+    # Crashed in the middle of the next record
+    with open(data_users.storage.journal_path, 'a', encoding='utf-8') as journal:
+        journal.write('{"op": "user", "server": "s1", "us')
+
+    data_users = Users(folder, {'engine': 'journal'})
+    assert data_users.data.get_server('s1').get_user('d1').rank == 'gold'
+    server = data_users.data.get_server('s1')
+    data_users.update_user(server, server.get_user('d1'), 42, 'Name', 'platinum')
+    data_users.close()
+
+    data = Users(folder, {'engine': 'journal'}).data
+    assert data.get_server('s1').get_user('d1').rank == 'platinum'
@@ -0,0 +1,90 @@
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """Bounded in-memory cache, entries expire after ttl seconds and the least recently used ones are evicted"""
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        entry = self._entries.get(key)
+        if entry is not None:
+            value, expires = entry
+            if expires > time.time():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value
+            del self._entries[key]
+        self.misses += 1
+        return default
+
+    def set(self, key, value):
+        if key in self._entries:
+            self._entries.move_to_end(key)
+        self._entries[key] = (value, time.time() + self.ttl)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def remove(self, key):
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __str__(self):
+        total = self.hits + self.misses
+        hit_rate = 100.0 * self.hits / total if total else 0.0
+        return '{0}/{1} entries, {2} hits, {3} misses ({4:.0f}% hit rate), {5} evicted'\
+            .format(len(self._entries), self.max_size, self.hits, self.misses, hit_rate, self.evictions)
+
+
+class StaleWhileRevalidateCache:
+    """
+    Cache with two lifetimes: entries younger than fresh_ttl are fresh, older ones are still served
+    until stale_ttl, but the caller is expected to refresh them
+    """
+
+    def __init__(self, max_size, fresh_ttl, stale_ttl):
+        self.fresh_ttl = fresh_ttl
+        self._cache = TTLCache(max_size, stale_ttl)
+        self.fresh_hits = 0
+        self.stale_hits = 0
+
+    def get(self, key):
+        """Returns (value, is_fresh) or None"""
+        entry = self._cache.get(key)
+        if entry is None:
+            return None
+        value, stored_time = entry
+        is_fresh = time.time() - stored_time < self.fresh_ttl
+        if is_fresh:
+            self.fresh_hits += 1
+        else:
+            self.stale_hits += 1
+        return value, is_fresh
+
+    def set(self, key, value):
+        self._cache.set(key, (value, time.time()))
+
+    def remove(self, key):
+        self._cache.remove(key)
+
+    def clear(self):
+        self._cache.clear()
+
+    def __len__(self):
+        return len(self._cache)
+
+    def __str__(self):
+        return '{0} ({1} fresh, {2} stale)'.format(self._cache, self.fresh_hits, self.stale_hits)
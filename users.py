@@ -1,56 +1,126 @@
-import os
+import sys
+import copy
 import logging
 import time
+import weakref
+import asyncio
 from hashlib import md5
-import jsonpickle
 from riot import RiotAPI
+import users_storage
 
 
 class Users:
     logger = logging.getLogger(__name__)
 
     salt = 'some_salt'
-    file_name = 'users.json'
     save_period = 60
+    flush_period = 60
+    compact_period = 300
+    evict_period = 600
 
-    def __init__(self, data_folder):
+    def __init__(self, data_folder, parameters=None):
+        parameters = parameters or {}
         self.is_dirty = False
         self.last_save_time = 0
+        self.save_future = None
+        self.flush_period = parameters.get('flush_period', Users.flush_period)
+        self.compact_period = parameters.get('compact_period', Users.compact_period)
+        self.evict_period = parameters.get('evict_period', Users.evict_period)
         self.data = ServersData([])
-        self.full_path = os.path.join(data_folder, Users.file_name)
+        self.storage = users_storage.create_storage(data_folder, parameters)
         self.load_users()
 
     def load_users(self):
-        self.logger.info('Loading users list from \'%s\'', self.full_path)
-        try:
-            f = open(self.full_path, 'r')
-            file_contents = f.read()
-            f.close()
-            self.logger.info('Users data loaded')
-            if file_contents:
-                self.data = jsonpickle.decode(file_contents)
-                self.data.initialize()
-                self.logger.info('Loaded %s servers, total %s users.', self.data.total_servers, self.data.total_users)
-            else:
-                self.logger.warning('No data was loaded from \'%s\'', self.full_path)
-        except IOError as e:
-            self.logger.warning('Couldn\'t open users file, nothing loaded, error: \'%s\'', e)
+        data = self.storage.load()
+        if data is not None:
+            self.data = data
+            self.data.initialize()
+            self.logger.info('Loaded %s servers, total %s users.', self.data.total_servers, self.data.total_users)
 
     def save_users(self, check_if_dirty=False):
+        if self.storage.is_incremental:
+            # Changes are already stored by the storage hooks
+            return
+
         if check_if_dirty:
             if not self.is_dirty:
                 return
 
         self.is_dirty = True
-        current_time = time.time()
-        if current_time - self.last_save_time > self.save_period:
-            self.logger.debug('Saving users data to file \'%s\'', self.full_path)
-            self.last_save_time = current_time
-            f = open(self.full_path, 'w')
-            file_contents = jsonpickle.encode(self.data)
-            f.write(file_contents)
-            f.close()
-            self.is_dirty = False
+        if time.time() - self.last_save_time > self.save_period and not self.is_saving:
+            self.start_save()
+
+    @property
+    def is_saving(self):
+        return self.save_future is not None
+
+    def start_save(self):
+        """Encodes and writes a snapshot of the data in a worker thread, so the event loop isn't blocked"""
+        self.last_save_time = time.time()
+        self.is_dirty = False
+        snapshot = self.storage.snapshot(self.data)
+        loop = asyncio.get_event_loop()
+        self.save_future = loop.run_in_executor(None, self.write_snapshot, snapshot)
+        self.save_future.add_done_callback(self.on_save_done)
+        return self.save_future
+
+    def write_snapshot(self, snapshot):
+        start_time = time.time()
+        unsaved = self.storage.save(snapshot)
+        if unsaved is None:
+            self.logger.info('Users data saved in %.3fs', time.time() - start_time)
+        return unsaved
+
+    def on_save_done(self, future):
+        self.save_future = None
+        if future.cancelled() or future.exception() is not None:
+            self.logger.error('Failed to save users data: %s', None if future.cancelled() else future.exception())
+            self.is_dirty = True
+        elif future.result() is not None:
+            # Back on the event loop, the storage state is safe to change here
+            self.storage.save_failed(future.result())
+            self.is_dirty = True
+
+    @asyncio.coroutine
+    def flusher(self):
+        """Writes the changes left dirty by the save_period throttle"""
+        self.logger.info('Users storage flusher START, period %ss', self.flush_period)
+        while not self.storage.is_incremental:
+            yield from asyncio.sleep(self.flush_period)
+            if self.is_dirty and not self.is_saving:
+                self.start_save()
+
+    @asyncio.coroutine
+    def flush(self):
+        """Waits for the running save and writes everything that is still dirty, used on shutdown"""
+        if self.is_saving:
+            yield from asyncio.wait([self.save_future])
+        if self.is_dirty and not self.storage.is_incremental:
+            self.logger.info('Flushing users data')
+            yield from asyncio.wait([self.start_save()])
+
+    @asyncio.coroutine
+    def compactor(self):
+        """Periodically folds changes of compacting storages (journal) into a new snapshot"""
+        self.logger.info('Users storage compactor START, period %ss', self.compact_period)
+        while self.storage.is_compacting:
+            yield from asyncio.sleep(self.compact_period)
+            if self.storage.needs_compaction and not self.is_saving:
+                self.storage.begin_compaction()
+                self.start_save()
+
+    @asyncio.coroutine
+    def evictor(self):
+        """Periodically unloads servers that weren't used for a while, for storages that can load them back"""
+        self.logger.info('Users storage evictor START, period %ss', self.evict_period)
+        while self.storage.evicts_servers:
+            yield from asyncio.sleep(self.evict_period)
+            # The files of a server being saved are not up to date yet
+            if not self.is_saving:
+                self.storage.evict_cold_servers(self.data)
+
+    def close(self):
+        self.storage.close()
 
     def get_user(self, member):
         server = self.data.get_or_create_server(member.server.id)
@@ -58,13 +128,20 @@ class Users:
 
     def remove_user(self, member):
         server = self.data.get_or_create_server(member.server.id)
-        server.remove_user(member.id)
+        self.remove_users_data(server, [member.id])
+
+    def remove_users_data(self, server, discord_ids):
+        server.remove_users(discord_ids)
+        for discord_id in discord_ids:
+            self.storage.user_removed(server.server_id, discord_id)
         self.save_users()
 
     def clear_user(self, member):
-        user = self.get_user(member)
+        server = self.data.get_or_create_server(member.server.id)
+        user = server.get_user(member.id)
         if user:
-            user.clear()
+            server.clear_user(user)
+            self.storage.user_changed(server.server_id, user)
             self.save_users()
         return user
 
@@ -72,15 +149,41 @@ class Users:
         server = self.data.get_or_create_server(member.server.id)
         return server.get_or_create_user(member.id)
 
-    def update_user(self, user, game_user_id, nickname, rank):
-        user.game_id = game_user_id
-        user.nickname = nickname
-        user.rank = rank
+    def set_user_nickname(self, member, nickname):
+        """New game nickname requested by user, game id is unknown until it's checked in RiotAPI"""
+        server = self.data.get_or_create_server(member.server.id)
+        user = server.get_or_create_user(member.id)
+        if user.nickname != nickname:
+            server.set_user_game_data(user, None, nickname)
+            user.confirmed = False
+            self.storage.user_changed(server.server_id, user)
+        return user
+
+    def set_user_cancer(self, member, cancer):
+        server = self.data.get_or_create_server(member.server.id)
+        user = server.get_or_create_user(member.id)
+        was_cancer = user.is_cancer
+        if was_cancer != cancer:
+            user.cancer = cancer
+            self.storage.user_changed(server.server_id, user)
+            self.save_users()
+        return user, was_cancer
+
+    def update_user(self, server, user, game_user_id, nickname, rank):
+        renamed = self.data.set_user_game_data(server, user, game_user_id, nickname)
+        user.rank = UserData.intern(rank)
+        self.storage.user_changed(server.server_id, user)
+        # Summoner rename reaches the stored data of the other memberships too
+        for other_server, other_user in renamed:
+            if other_user is not user:
+                self.storage.user_changed(other_server.server_id, other_user)
         self.save_users()
 
     def confirm_user(self, user, server):
         user.confirmed = True
         conflicted_users = server.clear_unconfirmed_users(user)
+        for changed_user in [user] + conflicted_users:
+            self.storage.user_changed(server.server_id, changed_user)
         self.save_users()
         return conflicted_users
 
@@ -92,6 +195,7 @@ class Users:
 
         server = self.get_or_create_server(server_id)
         if server.parameters.set_region(region):
+            self.storage.server_changed(server)
             self.save_users()
             self.logger.info('Region success')
             return True
@@ -104,33 +208,176 @@ class Users:
 
     def set_member_ban(self, member_id, ban_active=True):
         self.data.set_member_ban(member_id, ban_active)
+        self.storage.ban_changed(member_id, ban_active)
+        self.save_users()
+
+    def set_server_departed(self, server_id, departed=True):
+        """Bot left the server (or came back), its data is kept for a while before retention removes it"""
+        departed_at = time.time() if departed else None
+        if self.data.set_server_departed(server_id, departed_at):
+            self.logger.info('Server \'%s\' departed: %s', server_id, departed)
+            self.storage.server_departed(server_id, departed_at)
+            self.save_users()
+
+    def remove_server(self, server_id):
+        self.logger.info('Removing server \'%s\' data', server_id)
+        self.data.remove_server(server_id)
+        self.storage.server_removed(server_id)
         self.save_users()
 
 
 class ServersData(object):
-    def __init__(self, servers=[]):
-        self.servers = servers
+    # Lookup indexes, rebuilt by initialize() and not saved to the file
+    transient_fields = ('_servers_index', '_bans_index', '_accounts')
+    # Defaults for files written before the fields existed
+    bans = ()
+    departed = ()
+
+    def __init__(self, servers=None):
+        self.servers = servers if servers is not None else []
         self.bans = []
+        # server id -> time the bot left it
+        self.departed = {}
+        self.initialize()
+
+    def __getstate__(self):
+        return dict((k, v) for k, v in self.__dict__.items() if k not in self.transient_fields)
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+    def snapshot(self):
+        """Detached copy of the saved fields, it can be encoded in another thread while the data keeps changing"""
+        data = ServersData.__new__(ServersData)
+        data.__dict__.update(self.__getstate__())
+        data.servers = [server.snapshot() for server in self.servers]
+        data.bans = list(self.bans)
+        data.departed = dict(self.departed)
+        return data
 
     def initialize(self):
-        if not hasattr(self, 'bans'):
-            self.bans = []
+        self.bans = list(self.bans)
+        self.departed = dict(self.departed)
+        self._servers_index = {}
+        for server in self.servers:
+            server.initialize()
+            self._servers_index[server.server_id] = server
+        self._bans_index = set(self.bans)
+        # (discord id, game id) -> account shared by the memberships, while any of them uses it
+        self._accounts = weakref.WeakValueDictionary()
+        self.share_accounts()
+
+    def share_accounts(self):
+        """
+        One pass over all the memberships, linking the ones with the same discord and game id. The first loaded
+        membership gives the account its nickname, loaded data never renames an account
+        """
+        first_memberships = {}
+        for server in self.servers:
+            for user in server.users:
+                if not user.game_id or user.account is not None:
+                    continue
+                key = (user.discord_id, user.game_id)
+                account = self._accounts.get(key)
+                if account is None:
+                    first_user = first_memberships.get(key)
+                    if first_user is None:
+                        first_memberships[key] = user
+                        continue
+                    account = self.create_account(first_user)
+                self.join_account(server, user, account)
+
+    def share_server_accounts(self, server):
+        """Links the memberships of a server loaded after the others, see share_accounts"""
+        wanted = {}
+        for user in server.users:
+            if not user.game_id or user.account is not None:
+                continue
+            account = self._accounts.get((user.discord_id, user.game_id))
+            if account is not None:
+                self.join_account(server, user, account)
+            else:
+                wanted[user.discord_id] = user
+        for other_server in self.servers:
+            if not wanted:
+                break
+            if other_server is server:
+                continue
+            # Whatever is shorter: users of the other server or the ones still looking for their account
+            if len(other_server.users) < len(wanted):
+                pairs = [(other_user, wanted.get(other_user.discord_id)) for other_user in other_server.users]
+            else:
+                pairs = [(other_server.get_user(discord_id), user) for discord_id, user in wanted.items()]
+            for other_user, user in pairs:
+                if other_user is None or user is None or other_user.game_id != user.game_id:
+                    continue
+                self.join_account(server, user, other_user.account or self.create_account(other_user))
+                del wanted[user.discord_id]
+
+    def link_user(self, server, user):
+        """Account of the user shared with its other loaded memberships, None if it has none"""
+        if not user.game_id:
+            return None
+        if user.account is not None:
+            return user.account
+        account = self._accounts.get((user.discord_id, user.game_id))
+        if account is None:
+            for other_server in self.servers:
+                other_user = other_server.get_user(user.discord_id) if other_server is not server else None
+                if other_user is not None and other_user.game_id == user.game_id:
+                    account = other_user.account or self.create_account(other_user)
+                    break
+            else:
+                return None
+        self.join_account(server, user, account)
+        return account
+
+    def create_account(self, user):
+        account = Account(user.discord_id, user.game_id, user.nickname)
+        user.share_account(account)
+        self._accounts[(account.discord_id, account.game_id)] = account
+        return account
+
+    @staticmethod
+    def join_account(server, user, account):
+        old_nickname = user.nickname
+        user.share_account(account)
+        if old_nickname != account.nickname:
+            server.reindex_nickname(user, old_nickname)
+
+    def set_user_game_data(self, server, user, game_id, nickname):
+        """
+        Game data from RiotAPI is the newest there is, it renames the account shared with the other memberships.
+        Returns the (server, user) memberships the rename has reached
+        """
+        server.set_user_game_data(user, game_id, nickname)
+        account = self.link_user(server, user)
+        if account is None or account.nickname == nickname:
+            return []
+        return self.rename_account(account, nickname)
+
+    def rename_account(self, account, nickname):
+        old_nickname = account.nickname
+        account.nickname = nickname
+        renamed = []
+        for server in self.servers:
+            user = server.get_user(account.discord_id)
+            if user is not None and user.account is account:
+                server.reindex_nickname(user, old_nickname)
+                renamed.append((server, user))
+        return renamed
 
     def has_server(self, server_id):
         return self.get_server(server_id) is not None
 
     def get_or_create_server(self, server_id):
         server = self.get_server(server_id)
-        # We can fix None fields this way, because jsonpickle does not call the constructor at all
         if server is None:
             server = self.create_server(server_id)
         return server
 
     def get_server(self, server_id):
-        server = next((s for s in self.servers if s.server_id == server_id), None)
-        if server and not server.parameters:
-            server.parameters = ServerParameters()
-        return server
+        return self._servers_index.get(server_id)
 
     def get_server_by_index(self, index):
         if 0 <= index < self.total_servers:
@@ -140,8 +387,33 @@ class ServersData(object):
     def create_server(self, server_id):
         server = ServerData(server_id)
         self.servers.append(server)
+        self._servers_index[server_id] = server
         return server
 
+    def known_server_ids(self):
+        return [server.server_id for server in self.servers]
+
+    def is_known_server(self, server_id):
+        return server_id in self._servers_index
+
+    def remove_server(self, server_id):
+        server = self._servers_index.pop(server_id, None)
+        if server is not None:
+            self.servers.remove(server)
+        self.departed.pop(server_id, None)
+
+    def set_server_departed(self, server_id, departed_at):
+        """Returns True if it was changed, the time of the first departure is kept"""
+        if departed_at is None:
+            return self.departed.pop(server_id, None) is not None
+        if server_id in self.departed or not self.is_known_server(server_id):
+            return False
+        self.departed[server_id] = departed_at
+        return True
+
+    def departed_before(self, departed_time):
+        return [server_id for server_id, departed_at in self.departed.items() if departed_at < departed_time]
+
     @property
     def total_servers(self):
         return len(self.servers)
@@ -151,24 +423,188 @@ class ServersData(object):
         return sum(s.total_users for s in self.servers)
 
     def is_member_banned(self, member_id):
-        return member_id in self.bans
+        return member_id in self._bans_index
 
     def set_member_ban(self, member_id, ban_active=True):
         is_banned = self.is_member_banned(member_id)
         if ban_active and not is_banned:
             self.bans.append(member_id)
+            self._bans_index.add(member_id)
         if not ban_active and is_banned:
-            self.bans.remove(member_id);
+            self.bans.remove(member_id)
+            self._bans_index.discard(member_id)
+
+
+class ShardedServersData(ServersData):
+    """
+    Only the list of server ids is known at start, each server is loaded by shard_loader on first access.
+    Servers that were not accessed for a while can be evicted and loaded again later.
+    """
+
+    def __init__(self, server_ids, bans, departed, shard_loader):
+        self.shard_loader = shard_loader
+        self.server_ids = list(server_ids)
+        self.last_access = {}
+        super(ShardedServersData, self).__init__([])
+        for member_id in bans:
+            self.set_member_ban(member_id)
+        self.departed = dict(departed)
+
+    def initialize(self):
+        super(ShardedServersData, self).initialize()
+        self._server_ids_index = set(self.server_ids)
+
+    def get_server(self, server_id):
+        if server_id not in self._servers_index:
+            if server_id not in self._server_ids_index:
+                return None
+            server = self.shard_loader(server_id)
+            self.servers.append(server)
+            self._servers_index[server_id] = server
+            self.share_server_accounts(server)
+        self.last_access[server_id] = time.time()
+        return super(ShardedServersData, self).get_server(server_id)
+
+    def create_server(self, server_id):
+        server = super(ShardedServersData, self).create_server(server_id)
+        self.server_ids.append(server_id)
+        self._server_ids_index.add(server_id)
+        self.last_access[server_id] = time.time()
+        return server
+
+    def known_server_ids(self):
+        return list(self.server_ids)
+
+    def is_known_server(self, server_id):
+        return server_id in self._server_ids_index
+
+    def remove_server(self, server_id):
+        super(ShardedServersData, self).remove_server(server_id)
+        if server_id in self._server_ids_index:
+            self._server_ids_index.discard(server_id)
+            self.server_ids.remove(server_id)
+        self.last_access.pop(server_id, None)
+
+    def cold_servers(self, max_idle):
+        now = time.time()
+        return [server_id for server_id, access_time in self.last_access.items() if now - access_time > max_idle]
+
+    def evict_server(self, server_id):
+        server = self._servers_index.pop(server_id, None)
+        if server is not None:
+            self.servers.remove(server)
+        self.last_access.pop(server_id, None)
+
+    @property
+    def total_known_servers(self):
+        return len(self.server_ids)
 
 
 class ServerData(object):
-    def __init__(self, server_id, users=[], parameters=None):
+    # Lookup indexes, rebuilt by initialize() and not saved to the file
+    transient_fields = ('_users_index', '_game_ids_index', '_nicknames_index')
+    # Default for files written before server parameters existed
+    parameters = None
+
+    def __init__(self, server_id, users=None, parameters=None):
+        users = list(users) if users else []
         Users.logger.info('Creating server \'%s\' with %s users', server_id, len(users))
         self.server_id = server_id
         self.users = users
         if not parameters:
             parameters = ServerParameters()
         self.parameters = parameters
+        self.initialize()
+
+    def __getstate__(self):
+        return dict((k, v) for k, v in self.__dict__.items() if k not in self.transient_fields)
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+    def snapshot(self):
+        server = ServerData.__new__(ServerData)
+        server.__dict__.update(self.__getstate__())
+        server.users = [user.detached_copy() for user in self.users]
+        server.parameters = copy.copy(self.parameters)
+        return server
+
+    def initialize(self):
+        # Older files could share one users list between servers (mutable default argument)
+        self.users = list(self.users)
+        # jsonpickle does not call the constructor at all, so None fields of older files are fixed here
+        if not self.parameters:
+            self.parameters = ServerParameters()
+        self._users_index = {}
+        # game_id / normalized nickname -> discord id or set of ids, checked against the user data on lookup
+        self._game_ids_index = {}
+        self._nicknames_index = {}
+        for user in self.users:
+            # Files from before UserData.__setstate__ are restored attribute by attribute
+            user.initialize()
+            self._users_index[user.discord_id] = user
+            self._index_game_data(user)
+
+    def _index_game_data(self, user):
+        if user.game_id:
+            ServerData._add(self._game_ids_index, user.game_id, user.discord_id)
+        if user.nickname:
+            ServerData._add(self._nicknames_index, ServerData.nickname_key(user.nickname), user.discord_id)
+
+    def _unindex_game_data(self, user):
+        if user.game_id:
+            ServerData._discard(self._game_ids_index, user.game_id, user.discord_id)
+        if user.nickname:
+            ServerData._discard(self._nicknames_index, ServerData.nickname_key(user.nickname), user.discord_id)
+
+    @staticmethod
+    def _add(index, key, discord_id):
+        # Almost every key belongs to a single user, a set is made only for the shared ones
+        ids = index.get(key)
+        if ids is None:
+            index[key] = discord_id
+        elif isinstance(ids, set):
+            ids.add(discord_id)
+        elif ids != discord_id:
+            index[key] = {ids, discord_id}
+
+    @staticmethod
+    def _discard(index, key, discord_id):
+        ids = index.get(key)
+        if isinstance(ids, set):
+            ids.discard(discord_id)
+            if len(ids) == 1:
+                index[key] = ids.pop()
+        elif ids is not None and ids == discord_id:
+            del index[key]
+
+    @staticmethod
+    def nickname_key(nickname):
+        return RiotAPI.normalize_nickname(nickname)
+
+    def _indexed_users(self, index, key):
+        ids = index.get(key)
+        if ids is None:
+            return []
+        if not isinstance(ids, set):
+            ids = (ids,)
+        return [self._users_index[i] for i in ids if i in self._users_index]
+
+    def set_user_game_data(self, user, game_id, nickname):
+        self._unindex_game_data(user)
+        user.set_game_data(game_id, nickname)
+        self._index_game_data(user)
+
+    def clear_user(self, user):
+        self._unindex_game_data(user)
+        user.clear()
+
+    def reindex_nickname(self, user, old_nickname):
+        """Nickname of the user was changed through its shared account"""
+        if old_nickname:
+            ServerData._discard(self._nicknames_index, ServerData.nickname_key(old_nickname), user.discord_id)
+        if user.nickname:
+            ServerData._add(self._nicknames_index, ServerData.nickname_key(user.nickname), user.discord_id)
 
     def has_user(self, discord_id):
         return self.get_user(discord_id) is not None
@@ -180,7 +616,7 @@ class ServerData(object):
         return user
 
     def get_user(self, discord_id):
-        return next((u for u in self.users if u.discord_id == discord_id), None)
+        return self._users_index.get(discord_id)
 
     def get_user_by_index(self, index):
         if 0 <= index < self.total_users:
@@ -190,15 +626,29 @@ class ServerData(object):
     def remove_user(self, discord_id):
         user = self.get_user(discord_id)
         if user:
+            self._unindex_game_data(user)
+            del self._users_index[discord_id]
             self.users.remove(user)
 
+    def remove_users(self, discord_ids):
+        """Same as remove_user for many users, with a single pass over the users list"""
+        removed = set()
+        for discord_id in discord_ids:
+            user = self._users_index.pop(discord_id, None)
+            if user is not None:
+                self._unindex_game_data(user)
+                removed.add(id(user))
+        if removed:
+            self.users = [user for user in self.users if id(user) not in removed]
+
     def create_user(self, discord_id):
         user = UserData(discord_id)
         self.users.append(user)
+        self._users_index[discord_id] = user
         return user
 
     def find_confirmed_user(self, game_id):
-        for u in self.users:
+        for u in self._indexed_users(self._game_ids_index, game_id):
             if u.is_confirmed and u.game_id == game_id:
                 return u
         return None
@@ -206,7 +656,10 @@ class ServerData(object):
     def clear_unconfirmed_users(self, user):
         unconfirmed_users = []
 
-        for u in self.users:
+        candidates = set(self._indexed_users(self._game_ids_index, user.game_id))
+        if user.nickname:
+            candidates.update(self._indexed_users(self._nicknames_index, ServerData.nickname_key(user.nickname)))
+        for u in candidates:
             have_to_delete = False
             if u != user:
                 if u.game_id:
@@ -216,7 +669,7 @@ class ServerData(object):
                     have_to_delete = True
 
             if have_to_delete:
-                u.clear()
+                self.clear_user(u)
                 unconfirmed_users.append(u)
 
         return unconfirmed_users
@@ -226,34 +679,121 @@ class ServerData(object):
         return len(self.users)
 
 
+class Account(object):
+    """
+    Riot data shared by the memberships of one discord user with one game id on several servers. Created only
+    when a second membership shows up, a player who is on a single server keeps the data in the UserData.
+    """
+    __slots__ = ('discord_id', 'game_id', 'nickname', '_bind_hash', '__weakref__')
+
+    def __init__(self, discord_id, game_id, nickname):
+        self.discord_id = discord_id
+        self.game_id = game_id
+        self.nickname = nickname
+        self._bind_hash = None
+
+    @property
+    def bind_hash(self):
+        if self._bind_hash is None:
+            self._bind_hash = UserData.create_hash(self.game_id, self.discord_id)
+        return self._bind_hash
+
+
 class UserData(object):
+    """
+    Membership of a discord user in one server. Confirmed, cancer and rank are per server: the rank is rolled back
+    where the user isn't confirmed. The nickname is in the shared account when the user has one.
+    """
+    # There is one for every member of every server, so no per-instance __dict__
+    __slots__ = ('discord_id', 'rank', 'game_id', '_nickname', 'confirmed', 'cancer', 'account')
+    saved_fields = ('discord_id', 'rank', 'game_id', 'nickname', 'confirmed', 'cancer')
+    defaults = {'rank': '', 'game_id': '', '_nickname': '', 'confirmed': False, 'cancer': False}
+
+    def __new__(cls, *args, **kwargs):
+        user = super(UserData, cls).__new__(cls)
+        # jsonpickle and copy don't call __init__
+        user.account = None
+        return user
+
     def __init__(self, discord_id, rank='', game_id='', nickname='', confirmed=False, cancer=False):
         # Users.logger.info('Creating user \'%s\' with nickname \'%s\'', discord_id, nickname)
         self.discord_id = discord_id
-        self.rank = rank
+        self.rank = UserData.intern(rank)
         self.game_id = game_id
-        self.nickname = nickname
+        self._nickname = nickname
         self.confirmed = confirmed
         self.cancer = cancer
 
+    def __getstate__(self):
+        return dict((k, getattr(self, k)) for k in self.saved_fields if hasattr(self, k))
+
+    def __setstate__(self, state):
+        for k in self.saved_fields:
+            if k in state:
+                setattr(self, '_nickname' if k == 'nickname' else k, state[k])
+        self.initialize()
+
+    def initialize(self):
+        """Fills the fields missing in older files, so the properties don't have to check them"""
+        for k, default in UserData.defaults.items():
+            if not hasattr(self, k):
+                setattr(self, k, default)
+        self.rank = UserData.intern(self.rank)
+
+    def detached_copy(self):
+        """Copy with its own game data, changes of the shared account don't reach it"""
+        user = UserData.__new__(UserData)
+        user.discord_id = self.discord_id
+        user.rank = self.rank
+        user.game_id = self.game_id
+        user._nickname = self.nickname
+        user.confirmed = self.confirmed
+        user.cancer = self.cancer
+        return user
+
+    @staticmethod
+    def intern(text):
+        """Ranks repeat across all users, keep a single copy of each string"""
+        return sys.intern(text) if type(text) is str else text
+
+    @property
+    def nickname(self):
+        return self.account.nickname if self.account is not None else self._nickname
+
+    @nickname.setter
+    def nickname(self, nickname):
+        """Of this membership only, see ServersData.rename_account for the shared account"""
+        self.account = None
+        self._nickname = nickname
+
+    def set_game_data(self, game_id, nickname):
+        """Game data of this membership only, it leaves the shared account if the data doesn't match it anymore"""
+        if self.account is not None:
+            if self.account.game_id == game_id and self.account.nickname == nickname:
+                return
+            self.account = None
+        self.game_id = game_id
+        self._nickname = nickname
+
+    def share_account(self, account):
+        self.account = account
+        self._nickname = None
+
     def clear(self):
-        self.nickname = ''
-        self.game_id = ''
+        self.set_game_data('', '')
 
     @property
     def is_confirmed(self):
-        if not hasattr(self, 'confirmed'):
-            self.confirmed = False
         return self.confirmed
 
     @property
     def is_cancer(self):
-        if not hasattr(self, 'cancer'):
-            self.cancer = False
         return self.cancer
 
     @property
     def bind_hash(self):
+        if self.account is not None:
+            return self.account.bind_hash
         return UserData.create_hash(self.game_id, self.discord_id)
 
     @staticmethod
@@ -270,20 +810,23 @@ class UserData(object):
 
 
 class ServerParameters(object):
+    # Defaults for files written before the fields existed
+    language = 'eng'
+    is_salty = True
+    region = 'euw'
+
     def __init__(self, language='eng', is_salty=True, region='euw'):
         self.language = language
         self.is_salty = is_salty
         self.region = region
 
     def get_region(self):
-        if not hasattr(self, 'region'):
-            self.region = 'euw'
         return self.region
 
     def set_region(self, region):
         region = region.lower().strip()
         if RiotAPI.has_region(region):
-            self.region = region
+            self.region = sys.intern(region)
             return True
         else:
             return False
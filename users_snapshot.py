@@ -0,0 +1,171 @@
+"""
+Versioned binary snapshot of the users data: msgpack, zstd compressed when zstandard is installed
+
+Usage: python users_snapshot.py users.json users.bin [--no-compress]
+"""
+import struct
+import logging
+import argparse
+import jsonpickle
+import users
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+magic = b'EBUS'
+# magic, schema version, codec
+header_format = '<4sHB'
+header_size = struct.calcsize(header_format)
+
+codec_none = 0
+codec_zstd = 1
+
+# Schema 0: attributes of the jsonpickle objects as they are, every older file generation misses some of them
+# Schema 1: positional records with all the fields
+#   {'servers': [[server_id, [language, is_salty, region], [[discord_id, rank, game_id, nickname, confirmed, cancer]]]],
+#    'bans': [member_id]}
+# Schema 2: schema 1 plus the servers the bot has left, {'departed': {server_id: departed_at}}
+schema_version = 2
+
+
+def check_available():
+    if msgpack is None:
+        raise RuntimeError('Binary users snapshots need the msgpack package')
+
+
+def migrate_0_to_1(tree):
+    user_defaults = users.UserData('')
+    parameters_defaults = users.ServerParameters()
+    servers = []
+    for server in tree['servers']:
+        parameters = server.get('parameters') or {}
+        servers.append([
+            server['server_id'],
+            [parameters.get(field, getattr(parameters_defaults, field))
+             for field in ('language', 'is_salty', 'region')],
+            [[user.get(field, getattr(user_defaults, field)) for field in users.UserData.saved_fields]
+             for user in server.get('users') or []]])
+    return {'servers': servers, 'bans': list(tree.get('bans') or [])}
+
+
+def migrate_1_to_2(tree):
+    tree['departed'] = {}
+    return tree
+
+
+# Step from each schema version to the next one
+migrations = {
+    0: migrate_0_to_1,
+    1: migrate_1_to_2,
+}
+
+
+def migrate(tree, version):
+    if version > schema_version:
+        raise ValueError('Users snapshot schema {0} is newer than supported {1}'.format(version, schema_version))
+    while version < schema_version:
+        logger.info('Migrating users snapshot from schema %s to %s', version, version + 1)
+        tree = migrations[version](tree)
+        version += 1
+    return tree
+
+
+def legacy_tree(data):
+    """Schema 0 tree from the objects of a decoded jsonpickle file, without the defaults of the current classes"""
+    def attributes(obj, fields):
+        if hasattr(obj, '__dict__'):
+            return dict((k, obj.__dict__[k]) for k in fields if k in obj.__dict__)
+        return dict((k, getattr(obj, k)) for k in fields if hasattr(obj, k))
+    servers = []
+    for server in data.servers:
+        state = server.__dict__
+        parameters = state.get('parameters')
+        servers.append({
+            'server_id': state['server_id'],
+            'parameters': attributes(parameters, ('language', 'is_salty', 'region')) if parameters else None,
+            'users': [attributes(user, users.UserData.saved_fields) for user in state.get('users') or []]})
+    return {'servers': servers, 'bans': data.__dict__.get('bans')}
+
+
+def data_to_tree(data):
+    return {
+        'servers': [[server.server_id,
+                     [server.parameters.language, server.parameters.is_salty, server.parameters.region],
+                     [[user.discord_id, user.rank, user.game_id, user.nickname, user.confirmed, user.cancer]
+                      for user in server.users]]
+                    for server in data.servers],
+        'bans': list(data.bans),
+        'departed': dict(data.departed)}
+
+
+def tree_to_data(tree):
+    servers = [users.ServerData(server_id, [users.UserData(*user) for user in server_users],
+                                users.ServerParameters(*parameters))
+               for server_id, parameters, server_users in tree['servers']]
+    data = users.ServersData(servers)
+    for member_id in tree['bans']:
+        data.set_member_ban(member_id)
+    for server_id, departed_at in tree['departed'].items():
+        data.set_server_departed(server_id, departed_at)
+    return data
+
+
+def encode(data, compress=True):
+    check_available()
+    body = msgpack.packb(data_to_tree(data), use_bin_type=True)
+    codec = codec_none
+    if compress and zstandard is not None:
+        body = zstandard.ZstdCompressor().compress(body)
+        codec = codec_zstd
+    return struct.pack(header_format, magic, schema_version, codec) + body
+
+
+def decode(contents):
+    check_available()
+    if len(contents) < header_size:
+        raise ValueError('Users snapshot is truncated')
+    file_magic, version, codec = struct.unpack_from(header_format, contents)
+    if file_magic != magic:
+        raise ValueError('Not a users snapshot')
+    body = contents[header_size:]
+    if codec == codec_zstd:
+        if zstandard is None:
+            raise RuntimeError('Users snapshot is zstd compressed, the zstandard package is needed to read it')
+        body = zstandard.ZstdDecompressor().decompress(body)
+    elif codec != codec_none:
+        raise ValueError('Unknown users snapshot codec {0}'.format(codec))
+    tree = msgpack.unpackb(body, raw=False)
+    return tree_to_data(migrate(tree, version))
+
+
+def convert_jsonpickle(json_contents, compress=True):
+    """Binary snapshot of an old users.json, whatever generation of the classes it was written with"""
+    data = jsonpickle.decode(json_contents)
+    tree = migrate(legacy_tree(data), 0)
+    return encode(tree_to_data(tree), compress)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert users.json to a binary users snapshot')
+    parser.add_argument('source', help='jsonpickle users file')
+    parser.add_argument('target', help='binary snapshot to write')
+    parser.add_argument('--no-compress', action='store_true')
+    args = parser.parse_args()
+    with open(args.source, 'r') as f:
+        contents = convert_jsonpickle(f.read(), not args.no_compress)
+    with open(args.target, 'wb') as f:
+        f.write(contents)
+    print('Converted \'{0}\' to \'{1}\', {2} bytes'.format(args.source, args.target, len(contents)))
+
+
+if __name__ == '__main__':
+    main()
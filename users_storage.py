@@ -0,0 +1,581 @@
+import os
+import json
+import types
+import logging
+import sqlite3
+import tempfile
+import jsonpickle
+import users
+import users_snapshot
+
+
+def atomic_write(full_path, contents):
+    """Writes to a temporary file next to the target and renames it over, readers see the old or the new file"""
+    folder = os.path.dirname(os.path.abspath(full_path))
+    fd, temp_path = tempfile.mkstemp(prefix='.' + os.path.basename(full_path) + '.', dir=folder)
+    try:
+        with (os.fdopen(fd, 'wb') if isinstance(contents, bytes) else os.fdopen(fd, 'w', encoding='utf-8')) as f:
+            f.write(contents)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, full_path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+    # The rename itself is durable only after the directory is synced
+    if hasattr(os, 'O_DIRECTORY'):
+        dir_fd = os.open(folder, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+
+class UsersStorage:
+    """
+    Base class for Users storage engines. Users calls the *_changed hooks after every mutation
+    and save() with a detached snapshot of the data when it has to be written as a whole.
+    save() runs in a worker thread, everything else on the event loop.
+    """
+    logger = logging.getLogger(__name__)
+
+    # Incremental engines persist every change in the hooks and don't need full saves
+    is_incremental = False
+    # Engines that have to fold their changes into a snapshot from time to time, see begin_compaction()
+    is_compacting = False
+    # Engines that load servers lazily and can unload the unused ones, see evict_cold_servers()
+    evicts_servers = False
+
+    def load(self):
+        """Returns loaded ServersData or None if there is nothing to load"""
+        raise NotImplementedError()
+
+    def snapshot(self, data):
+        """Detached copy of everything save() has to write, taken on the event loop"""
+        return data.snapshot()
+
+    def save(self, data):
+        """
+        Runs in a worker thread, so it must not touch the storage state. Returns what was left unsaved or None,
+        it's handed back to save_failed() on the event loop
+        """
+        raise NotImplementedError()
+
+    def save_failed(self, unsaved):
+        pass
+
+    def user_changed(self, server_id, user):
+        pass
+
+    def user_removed(self, server_id, discord_id):
+        pass
+
+    def server_changed(self, server):
+        pass
+
+    def ban_changed(self, member_id, ban_active):
+        pass
+
+    def server_departed(self, server_id, departed_at):
+        pass
+
+    def server_removed(self, server_id):
+        pass
+
+    @property
+    def needs_compaction(self):
+        return False
+
+    def begin_compaction(self):
+        """Called right before the snapshot that includes all the changes so far is saved"""
+        pass
+
+    def evict_cold_servers(self, data):
+        pass
+
+    def close(self):
+        pass
+
+
+class JsonPickleStorage(UsersStorage):
+    """The whole data tree in a single jsonpickle file"""
+    file_name = 'users.json'
+
+    def __init__(self, data_folder, parameters=None):
+        self.full_path = os.path.join(data_folder, JsonPickleStorage.file_name)
+
+    def load(self):
+        self.logger.info('Loading users list from \'%s\'', self.full_path)
+        try:
+            with open(self.full_path, 'r') as f:
+                file_contents = f.read()
+            self.logger.info('Users data loaded')
+            if file_contents:
+                return jsonpickle.decode(file_contents)
+            self.logger.warning('No data was loaded from \'%s\'', self.full_path)
+        except IOError as e:
+            self.logger.warning('Couldn\'t open users file, nothing loaded, error: \'%s\'', e)
+        return None
+
+    def save(self, data):
+        self.logger.debug('Saving users data to file \'%s\'', self.full_path)
+        atomic_write(self.full_path, jsonpickle.encode(data))
+
+
+class SqliteStorage(UsersStorage):
+    """SQLite database in WAL mode, every change writes only the affected row"""
+    file_name = 'users.sqlite'
+    is_incremental = True
+
+    schema = [
+        'CREATE TABLE IF NOT EXISTS servers (server_id TEXT PRIMARY KEY)',
+        'CREATE TABLE IF NOT EXISTS parameters (server_id TEXT PRIMARY KEY, language TEXT, is_salty INTEGER, '
+        'region TEXT)',
+        # No type for game_id, so Riot ids keep being numbers
+        'CREATE TABLE IF NOT EXISTS users (server_id TEXT, discord_id TEXT, rank TEXT, game_id, nickname TEXT, '
+        'confirmed INTEGER, cancer INTEGER, PRIMARY KEY (server_id, discord_id))',
+        'CREATE TABLE IF NOT EXISTS bans (member_id TEXT PRIMARY KEY)',
+        'CREATE TABLE IF NOT EXISTS departed (server_id TEXT PRIMARY KEY, departed_at REAL)',
+    ]
+
+    def __init__(self, data_folder, parameters=None):
+        self.data_folder = data_folder
+        self.full_path = os.path.join(data_folder, SqliteStorage.file_name)
+        self.logger.info('Opening users database \'%s\'', self.full_path)
+        self.db = sqlite3.connect(self.full_path)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        for statement in SqliteStorage.schema:
+            self.db.execute(statement)
+        self.db.commit()
+
+    def load(self):
+        if self.db.execute('SELECT COUNT(*) FROM servers').fetchone()[0] == 0:
+            migrated_data = self.migrate_from_json()
+            if migrated_data is not None:
+                return migrated_data
+
+        parameters = {}
+        for server_id, language, is_salty, region in self.db.execute(
+                'SELECT server_id, language, is_salty, region FROM parameters'):
+            parameters[server_id] = users.ServerParameters(language, bool(is_salty), region)
+
+        servers_users = {}
+        for server_id, discord_id, rank, game_id, nickname, confirmed, cancer in self.db.execute(
+                'SELECT server_id, discord_id, rank, game_id, nickname, confirmed, cancer FROM users ORDER BY rowid'):
+            servers_users.setdefault(server_id, []).append(
+                users.UserData(discord_id, rank, game_id, nickname, bool(confirmed), bool(cancer)))
+
+        servers = [users.ServerData(server_id, servers_users.get(server_id), parameters.get(server_id))
+                   for (server_id,) in self.db.execute('SELECT server_id FROM servers ORDER BY rowid')]
+        data = users.ServersData(servers)
+        for (member_id,) in self.db.execute('SELECT member_id FROM bans ORDER BY rowid'):
+            data.set_member_ban(member_id)
+        for server_id, departed_at in self.db.execute('SELECT server_id, departed_at FROM departed'):
+            data.set_server_departed(server_id, departed_at)
+        return data
+
+    def migrate_from_json(self):
+        """One-shot import of the old users.json, the file is kept renamed to users.json.migrated"""
+        json_storage = JsonPickleStorage(self.data_folder)
+        if not os.path.exists(json_storage.full_path):
+            return None
+        data = json_storage.load()
+        if data is None:
+            return None
+        data.initialize()
+        self.logger.warning('Migrating %s servers, %s users from \'%s\' to \'%s\'',
+                            data.total_servers, data.total_users, json_storage.full_path, self.full_path)
+        self.save(data)
+        os.rename(json_storage.full_path, json_storage.full_path + '.migrated')
+        return data
+
+    def save(self, data):
+        """Writes the whole data, used for migration"""
+        with self.db:
+            for server in data.servers:
+                self._write_server(server)
+                for user in server.users:
+                    self._write_user(server.server_id, user)
+            for member_id in data.bans:
+                self.db.execute('INSERT OR IGNORE INTO bans (member_id) VALUES (?)', (member_id,))
+            for server_id, departed_at in data.departed.items():
+                self.db.execute('INSERT OR REPLACE INTO departed (server_id, departed_at) VALUES (?, ?)',
+                                (server_id, departed_at))
+
+    def _write_server(self, server):
+        parameters = server.parameters
+        self.db.execute('INSERT OR IGNORE INTO servers (server_id) VALUES (?)', (server.server_id,))
+        self.db.execute('INSERT OR REPLACE INTO parameters (server_id, language, is_salty, region) VALUES (?, ?, ?, ?)',
+                        (server.server_id, parameters.language, int(bool(parameters.is_salty)),
+                         parameters.get_region()))
+
+    def _write_user(self, server_id, user):
+        self.db.execute('INSERT OR REPLACE INTO users (server_id, discord_id, rank, game_id, nickname, confirmed, cancer) '
+                        'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                        (server_id, user.discord_id, user.rank, user.game_id, user.nickname,
+                         int(bool(user.is_confirmed)), int(bool(user.is_cancer))))
+
+    def user_changed(self, server_id, user):
+        with self.db:
+            self.db.execute('INSERT OR IGNORE INTO servers (server_id) VALUES (?)', (server_id,))
+            self._write_user(server_id, user)
+
+    def user_removed(self, server_id, discord_id):
+        with self.db:
+            self.db.execute('DELETE FROM users WHERE server_id = ? AND discord_id = ?', (server_id, discord_id))
+
+    def server_changed(self, server):
+        with self.db:
+            self._write_server(server)
+
+    def ban_changed(self, member_id, ban_active):
+        with self.db:
+            if ban_active:
+                self.db.execute('INSERT OR IGNORE INTO bans (member_id) VALUES (?)', (member_id,))
+            else:
+                self.db.execute('DELETE FROM bans WHERE member_id = ?', (member_id,))
+
+    def server_departed(self, server_id, departed_at):
+        with self.db:
+            if departed_at is not None:
+                self.db.execute('INSERT OR REPLACE INTO departed (server_id, departed_at) VALUES (?, ?)',
+                                (server_id, departed_at))
+            else:
+                self.db.execute('DELETE FROM departed WHERE server_id = ?', (server_id,))
+
+    def server_removed(self, server_id):
+        with self.db:
+            for table in ('servers', 'parameters', 'users', 'departed'):
+                self.db.execute('DELETE FROM {0} WHERE server_id = ?'.format(table), (server_id,))
+
+    def close(self):
+        self.db.close()
+
+
+class JournalStorage(JsonPickleStorage):
+    """
+    users.json snapshot plus an append-only users.journal with one JSON record per change.
+    Compaction moves the journal aside to users.journal.old and starts a new one, the old journal is deleted
+    once the snapshot with its changes is saved. Loading replays both journals over the snapshot.
+    """
+    journal_file_name = 'users.journal'
+    old_journal_suffix = '.old'
+    is_incremental = True
+    is_compacting = True
+
+    def __init__(self, data_folder, parameters=None):
+        super(JournalStorage, self).__init__(data_folder, parameters)
+        parameters = parameters or {}
+        self.journal_path = os.path.join(data_folder, JournalStorage.journal_file_name)
+        self.old_journal_path = self.journal_path + JournalStorage.old_journal_suffix
+        self.fsync = parameters.get('journal_fsync', False)
+        self.records = 0
+        self.journal = None
+
+    def load(self):
+        data = super(JournalStorage, self).load()
+        if data is None:
+            data = users.ServersData([])
+        data.initialize()
+        self.records = self.replay(data, self.old_journal_path) + self.replay(data, self.journal_path)
+        # Both get appended to: new records here, the journal itself on the next compaction
+        self.truncate_torn_record(self.old_journal_path)
+        self.truncate_torn_record(self.journal_path)
+        self.journal = open(self.journal_path, 'a', encoding='utf-8')
+        return data
+
+    def truncate_torn_record(self, journal_path):
+        """Cuts the record a crash left without its newline, otherwise the next append is glued to it"""
+        if not os.path.exists(journal_path):
+            return
+        with open(journal_path, 'rb+') as journal:
+            size = journal.seek(0, os.SEEK_END)
+            end = size
+            while end > 0:
+                start = max(end - 4096, 0)
+                journal.seek(start)
+                newline = journal.read(end - start).rfind(b'\n')
+                if newline >= 0:
+                    end = start + newline + 1
+                    break
+                end = start
+            if end != size:
+                self.logger.warning('Truncating torn journal record at byte %s of \'%s\'', end, journal_path)
+                journal.truncate(end)
+
+    def replay(self, data, journal_path):
+        if not os.path.exists(journal_path):
+            return 0
+        records = 0
+        with open(journal_path, encoding='utf-8') as journal:
+            for line in journal:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Crashed in the middle of writing the last record
+                    self.logger.warning('Skipping broken journal record #%s: \'%s\'', records + 1, line.strip())
+                    continue
+                JournalStorage.apply(data, record)
+                records += 1
+        self.logger.info('Replayed %s journal records from \'%s\'', records, journal_path)
+        return records
+
+    @staticmethod
+    def apply(data, record):
+        op = record['op']
+        if op == 'user':
+            discord_id, rank, game_id, nickname, confirmed, cancer = record['user']
+            server = data.get_or_create_server(record['server'])
+            user = server.get_or_create_user(discord_id)
+            # Records are in the order of the changes, so a rename replays like it happened
+            data.set_user_game_data(server, user, game_id, nickname)
+            user.rank = users.UserData.intern(rank)
+            user.confirmed = confirmed
+            user.cancer = cancer
+        elif op == 'remove_user':
+            data.get_or_create_server(record['server']).remove_user(record['discord_id'])
+        elif op == 'server':
+            language, is_salty, region = record['parameters']
+            parameters = data.get_or_create_server(record['server']).parameters
+            parameters.language = language
+            parameters.is_salty = is_salty
+            parameters.region = region
+        elif op == 'ban':
+            data.set_member_ban(record['member'], record['active'])
+        elif op == 'departed':
+            data.set_server_departed(record['server'], record['at'])
+        elif op == 'remove_server':
+            data.remove_server(record['server'])
+
+    def append(self, record):
+        self.journal.write(json.dumps(record, ensure_ascii=False, separators=(',', ':')) + '\n')
+        self.journal.flush()
+        if self.fsync:
+            os.fsync(self.journal.fileno())
+        self.records += 1
+
+    def user_changed(self, server_id, user):
+        self.append({'op': 'user', 'server': server_id, 'user': [
+            user.discord_id, user.rank, user.game_id, user.nickname, user.is_confirmed, user.is_cancer]})
+
+    def user_removed(self, server_id, discord_id):
+        self.append({'op': 'remove_user', 'server': server_id, 'discord_id': discord_id})
+
+    def server_changed(self, server):
+        parameters = server.parameters
+        self.append({'op': 'server', 'server': server.server_id,
+                     'parameters': [parameters.language, parameters.is_salty, parameters.get_region()]})
+
+    def ban_changed(self, member_id, ban_active):
+        self.append({'op': 'ban', 'member': member_id, 'active': ban_active})
+
+    def server_departed(self, server_id, departed_at):
+        self.append({'op': 'departed', 'server': server_id, 'at': departed_at})
+
+    def server_removed(self, server_id):
+        self.append({'op': 'remove_server', 'server': server_id})
+
+    @property
+    def needs_compaction(self):
+        return self.records > 0
+
+    def begin_compaction(self):
+        self.logger.info('Compacting %s journal records into \'%s\'', self.records, self.full_path)
+        self.journal.close()
+        if os.path.exists(self.old_journal_path):
+            # The previous compaction failed, its journal still has to be kept until a snapshot is saved
+            with open(self.old_journal_path, 'a', encoding='utf-8') as old_journal, \
+                    open(self.journal_path, encoding='utf-8') as journal:
+                old_journal.write(journal.read())
+            os.remove(self.journal_path)
+        else:
+            os.replace(self.journal_path, self.old_journal_path)
+        self.journal = open(self.journal_path, 'a', encoding='utf-8')
+        self.records = 0
+
+    def save(self, data):
+        super(JournalStorage, self).save(data)
+        if os.path.exists(self.old_journal_path):
+            os.remove(self.old_journal_path)
+
+    def close(self):
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+
+
+class ShardedStorage(UsersStorage):
+    """
+    users/manifest.json with the server ids and bans, plus users/<server_id>.json for every server.
+    Servers are loaded on first access and only the changed ones are written.
+    """
+    folder_name = 'users'
+    manifest_file_name = 'manifest.json'
+    manifest_version = 1
+    evicts_servers = True
+
+    default_max_idle = 3600
+
+    def __init__(self, data_folder, parameters=None):
+        parameters = parameters or {}
+        self.data_folder = data_folder
+        self.folder = os.path.join(data_folder, ShardedStorage.folder_name)
+        self.manifest_path = os.path.join(self.folder, ShardedStorage.manifest_file_name)
+        self.max_idle = parameters.get('server_max_idle', ShardedStorage.default_max_idle)
+        self.dirty_servers = set()
+        self.removed_servers = set()
+        os.makedirs(self.folder, exist_ok=True)
+
+    def shard_path(self, server_id):
+        return os.path.join(self.folder, '{0}.json'.format(server_id))
+
+    def load(self):
+        if not os.path.exists(self.manifest_path):
+            self.migrate_from_json()
+        manifest = {'servers': [], 'bans': []}
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, encoding='utf-8') as f:
+                manifest = json.load(f)
+        self.logger.info('Users manifest \'%s\' lists %s servers', self.manifest_path, len(manifest['servers']))
+        return users.ShardedServersData(manifest['servers'], manifest['bans'], manifest.get('departed', {}),
+                                        self.load_shard)
+
+    def load_shard(self, server_id):
+        shard_path = self.shard_path(server_id)
+        try:
+            with open(shard_path, encoding='utf-8') as f:
+                server = jsonpickle.decode(f.read())
+            self.logger.debug('Loaded server shard \'%s\'', shard_path)
+        except IOError as e:
+            # Servers are listed as soon as they are created, but written only after the first change
+            self.logger.debug('No server shard \'%s\': %s', shard_path, e)
+            server = users.ServerData(server_id)
+        server.initialize()
+        return server
+
+    def migrate_from_json(self):
+        """One-shot split of the old users.json, the file is kept renamed to users.json.migrated"""
+        json_storage = JsonPickleStorage(self.data_folder)
+        if not os.path.exists(json_storage.full_path):
+            return
+        data = json_storage.load()
+        if data is None:
+            return
+        data.initialize()
+        self.logger.warning('Migrating %s servers, %s users from \'%s\' to \'%s\'',
+                            data.total_servers, data.total_users, json_storage.full_path, self.folder)
+        if self.save(ShardedStorage.make_snapshot(data.servers, data)) is not None:
+            raise IOError('Couldn\'t write the migrated server shards to \'{0}\''.format(self.folder))
+        os.rename(json_storage.full_path, json_storage.full_path + '.migrated')
+
+    @staticmethod
+    def make_snapshot(servers, data, removed_servers=()):
+        return types.SimpleNamespace(servers=[s.snapshot() for s in servers], server_ids=data.known_server_ids(),
+                                     bans=list(data.bans), departed=dict(data.departed),
+                                     removed_servers=list(removed_servers))
+
+    def snapshot(self, data):
+        servers = [data.get_server(server_id) for server_id in self.dirty_servers]
+        snapshot = ShardedStorage.make_snapshot([s for s in servers if s is not None], data, self.removed_servers)
+        self.dirty_servers = set()
+        self.removed_servers = set()
+        return snapshot
+
+    def save(self, snapshot):
+        """Returns the (dirty, removed) server ids to write again if anything failed"""
+        try:
+            for server in snapshot.servers:
+                atomic_write(self.shard_path(server.server_id), jsonpickle.encode(server))
+            manifest = {'version': ShardedStorage.manifest_version, 'servers': snapshot.server_ids,
+                        'bans': snapshot.bans, 'departed': snapshot.departed}
+            atomic_write(self.manifest_path, json.dumps(manifest))
+        except Exception as e:
+            self.logger.error('Failed to write server shards to \'%s\': %s', self.folder, e)
+            return [server.server_id for server in snapshot.servers], snapshot.removed_servers
+        # Shards are deleted only when the manifest doesn't list them anymore
+        for server_id in snapshot.removed_servers:
+            if os.path.exists(self.shard_path(server_id)):
+                os.remove(self.shard_path(server_id))
+        self.logger.debug('Saved %s server shards, removed %s', len(snapshot.servers), len(snapshot.removed_servers))
+
+    def save_failed(self, unsaved):
+        dirty_servers, removed_servers = unsaved
+        # Removed again while the save was running
+        self.dirty_servers.update(set(dirty_servers) - self.removed_servers)
+        self.removed_servers.update(removed_servers)
+
+    def user_changed(self, server_id, user):
+        self.dirty_servers.add(server_id)
+
+    def user_removed(self, server_id, discord_id):
+        self.dirty_servers.add(server_id)
+
+    def server_changed(self, server):
+        self.dirty_servers.add(server.server_id)
+
+    def server_removed(self, server_id):
+        self.dirty_servers.discard(server_id)
+        self.removed_servers.add(server_id)
+
+    def evict_cold_servers(self, data):
+        evicted = 0
+        for server_id in data.cold_servers(self.max_idle):
+            if server_id not in self.dirty_servers:
+                data.evict_server(server_id)
+                evicted += 1
+        if evicted:
+            self.logger.info('Evicted %s cold servers, %s of %s servers are loaded',
+                             evicted, data.total_servers, data.total_known_servers)
+
+
+class BinaryStorage(UsersStorage):
+    """Versioned binary snapshot in users.bin, see users_snapshot"""
+    file_name = 'users.bin'
+
+    def __init__(self, data_folder, parameters=None):
+        parameters = parameters or {}
+        users_snapshot.check_available()
+        self.data_folder = data_folder
+        self.full_path = os.path.join(data_folder, BinaryStorage.file_name)
+        self.compress = parameters.get('compress', True)
+
+    def load(self):
+        if not os.path.exists(self.full_path):
+            return self.migrate_from_json()
+        self.logger.info('Loading users snapshot from \'%s\'', self.full_path)
+        with open(self.full_path, 'rb') as f:
+            return users_snapshot.decode(f.read())
+
+    def migrate_from_json(self):
+        """One-shot conversion of the old users.json, the file is kept renamed to users.json.migrated"""
+        json_path = os.path.join(self.data_folder, JsonPickleStorage.file_name)
+        if not os.path.exists(json_path):
+            return None
+        self.logger.warning('Converting \'%s\' to \'%s\'', json_path, self.full_path)
+        with open(json_path, 'r') as f:
+            atomic_write(self.full_path, users_snapshot.convert_jsonpickle(f.read(), self.compress))
+        os.rename(json_path, json_path + '.migrated')
+        return self.load()
+
+    def save(self, data):
+        self.logger.debug('Saving users snapshot to \'%s\'', self.full_path)
+        atomic_write(self.full_path, users_snapshot.encode(data, self.compress))
+
+
+engines = {
+    'json': JsonPickleStorage,
+    'sqlite': SqliteStorage,
+    'journal': JournalStorage,
+    'sharded': ShardedStorage,
+    'binary': BinaryStorage,
+}
+
+
+def create_storage(data_folder, parameters):
+    engine = parameters.get('engine', 'json')
+    if engine not in engines:
+        raise ValueError('Unknown users storage engine \'{0}\', use one of: {1}'
+                         .format(engine, ', '.join(sorted(engines))))
+    UsersStorage.logger.info('Using \'%s\' users storage', engine)
+    return engines[engine](data_folder, parameters)